@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Retention job for the check_ins table
+Moves check-ins older than CHECKIN_RETENTION_DAYS (default: 365) into
+check_ins_archive so the hot table stays small
+
+Run it periodically (e.g. as a nightly Railway cron job):
+    python archive_checkins.py
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete
+from main import app
+from db import db
+from models.models import CheckIn, CheckInArchive
+
+log = logging.getLogger(__name__)
+
+RETENTION_DAYS = int(os.environ.get("CHECKIN_RETENTION_DAYS", "365"))
+
+# Rows moved per transaction, to keep locks on check_ins short
+ARCHIVE_BATCH_SIZE = 1000
+
+ARCHIVED_COLUMNS = ["id", "customer_id", "check_in_time", "session_type", "notes", "qb_invoice_id", "is_manual"]
+
+def archive_checkins(retention_days=RETENTION_DAYS):
+    """Move old check-ins to the archive table, returns the number of rows moved"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    moved = 0
+    
+    with app.app_context():
+        while True:
+            ids = db.session.execute(
+                select(CheckIn.id)
+                .where(CheckIn.check_in_time < cutoff)
+                .order_by(CheckIn.id)
+                .limit(ARCHIVE_BATCH_SIZE)
+            ).scalars().all()
+            if not ids:
+                break
+            
+            db.session.execute(
+                insert(CheckInArchive).from_select(
+                    ARCHIVED_COLUMNS,
+                    select(*[getattr(CheckIn, c) for c in ARCHIVED_COLUMNS]).where(CheckIn.id.in_(ids))
+                )
+            )
+            db.session.execute(delete(CheckIn).where(CheckIn.id.in_(ids)))
+            db.session.commit()
+            moved += len(ids)
+    
+    log.info("Archived %d check-ins older than %s", moved, cutoff.date().isoformat())
+    return moved
+
+if __name__ == "__main__":
+    archive_checkins()
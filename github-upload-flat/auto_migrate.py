@@ -1,77 +1,172 @@
 """
 Auto-migration script that runs when the app starts
-This will automatically add the customer_type and is_manual columns
+This will automatically add the customer_type and is_manual columns, and
+the QuickBooks ID columns (also on SQLite)
 """
 
-import os
-from sqlalchemy import create_engine, text, inspect
+from contextlib import contextmanager
+from sqlalchemy import text, inspect
+from db import db
 
-def auto_migrate():
+# Arbitrary application-wide key for the PostgreSQL advisory lock
+MIGRATION_LOCK_KEY = 72_114_511
+
+# Rows updated per transaction when backfilling a new column
+BACKFILL_BATCH_SIZE = 1000
+
+def add_qb_id_columns(connection, inspector, tables):
+    """
+    Add the QuickBooks ID columns to tables created before they existed
+    
+    They are nullable and filled in lazily, so a plain ADD COLUMN works on
+    both PostgreSQL and SQLite.
+    
+    Args:
+        connection: Connection inside the migration transaction
+        inspector: Inspector for the same engine
+        tables: Set of existing table names
+    """
+    if 'customers' in tables and 'qb_customer_id' not in {col['name'] for col in inspector.get_columns('customers')}:
+        print("📝 Adding qb_customer_id column...")
+        connection.execute(text(
+            "ALTER TABLE customers ADD COLUMN qb_customer_id VARCHAR(50)"
+        ))
+    if 'session_types' in tables and 'qb_item_id' not in {col['name'] for col in inspector.get_columns('session_types')}:
+        print("📝 Adding qb_item_id column...")
+        connection.execute(text(
+            "ALTER TABLE session_types ADD COLUMN qb_item_id VARCHAR(50)"
+        ))
+
+@contextmanager
+def migration_lock(engine):
+    """
+    Serialize schema setup across gunicorn workers
+    
+    On PostgreSQL, holds a session-level advisory lock for the duration of
+    the block: the first worker runs the migration, the others wait and
+    then find the schema already up to date. No-op on other databases.
+    """
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    
+    with engine.connect() as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+def auto_migrate(app):
     """
     Automatically migrate the database on app startup
     Only runs if columns don't exist yet
+    
+    Reuses the app's SQLAlchemy engine (and its connection pool) instead of
+    creating a second one.
     """
     try:
-        # Get database URL
-        database_url = os.environ.get('DATABASE_URL')
-        
-        if not database_url:
-            print("⚠️  DATABASE_URL not found, skipping migration")
-            return
-        
-        # Fix Railway PostgreSQL URL
-        if database_url.startswith('postgres://'):
-            database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        with app.app_context():
+            engine = db.engine
         
-        # Skip if using SQLite (local development)
-        if 'sqlite' in database_url:
-            print("ℹ️  Using SQLite, skipping PostgreSQL migration")
+        # Only the QuickBooks ID columns are migrated on SQLite (local
+        # development) - the app reads them on every request
+        if engine.dialect.name != 'postgresql':
+            inspector = inspect(engine)
+            with engine.begin() as connection:
+                add_qb_id_columns(connection, inspector, set(inspector.get_table_names()))
+            print("ℹ️  Not using PostgreSQL, skipping the rest of the migration")
             return
         
         print("🔄 Checking database schema...")
         
-        # Create engine
-        engine = create_engine(database_url)
         inspector = inspect(engine)
         
+        # Snapshot the schema once up front
+        tables = set(inspector.get_table_names())
+        
         # Check if tables exist
-        if 'customers' not in inspector.get_table_names():
+        if 'customers' not in tables or 'check_ins' not in tables:
             print("ℹ️  Tables not created yet, skipping migration")
             return
         
-        with engine.connect() as connection:
+        customer_columns = {col['name'] for col in inspector.get_columns('customers')}
+        checkin_columns = {col['name'] for col in inspector.get_columns('check_ins')}
+        
+        added_customer_type = False
+        
+        # All DDL runs in a single transaction with one commit
+        with engine.begin() as connection:
             # Check if customer_type column exists
-            columns = [col['name'] for col in inspector.get_columns('customers')]
-            
-            if 'customer_type' not in columns:
+            if 'customer_type' not in customer_columns:
                 print("📝 Adding customer_type column...")
                 connection.execute(text(
                     "ALTER TABLE customers ADD COLUMN customer_type VARCHAR(20) DEFAULT 'in-person'"
                 ))
-                connection.commit()
-                print("   ✅ customer_type column added")
+                added_customer_type = True
             else:
                 print("   ✓ customer_type column already exists")
             
             # Check if is_manual column exists
-            checkin_columns = [col['name'] for col in inspector.get_columns('check_ins')]
-            
             if 'is_manual' not in checkin_columns:
                 print("📝 Adding is_manual column...")
                 connection.execute(text(
                     "ALTER TABLE check_ins ADD COLUMN is_manual BOOLEAN DEFAULT FALSE"
                 ))
-                connection.commit()
-                print("   ✅ is_manual column added")
             else:
                 print("   ✓ is_manual column already exists")
             
-            # Update existing customers
+            add_qb_id_columns(connection, inspector, tables)
+            
+            # Indexes declared on the models are only created by create_all()
+            # for new tables, so add them to existing databases here
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_checkins_cust_time ON check_ins (customer_id, check_in_time)"
+            ))
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_check_ins_check_in_time ON check_ins (check_in_time)"
+            ))
             connection.execute(text(
-                "UPDATE customers SET customer_type = 'in-person' WHERE customer_type IS NULL"
+                "CREATE INDEX IF NOT EXISTS ix_check_ins_session_type ON check_ins (session_type)"
             ))
-            connection.commit()
             
+            # The QR lookup index is UNIQUE (at most one row per scan) - but
+            # only switch an existing database over once its data allows it
+            qr_index = next((ix for ix in inspector.get_indexes('customers') if ix['name'] == 'ix_customers_qr_code_data'), None)
+            if not (qr_index and qr_index['unique']):
+                duplicate = connection.execute(text(
+                    "SELECT qr_code_data FROM customers WHERE qr_code_data IS NOT NULL "
+                    "GROUP BY qr_code_data HAVING COUNT(*) > 1 LIMIT 1"
+                )).first()
+                if duplicate:
+                    print("⚠️  Some customers share a QR code - keeping a non-unique QR index")
+                    connection.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_customers_qr_code_data ON customers (qr_code_data)"
+                    ))
+                else:
+                    print("📝 Making the QR code index unique...")
+                    connection.execute(text("DROP INDEX IF EXISTS ix_customers_qr_code_data"))
+                    connection.execute(text(
+                        "CREATE UNIQUE INDEX ix_customers_qr_code_data ON customers (qr_code_data)"
+                    ))
+        
+        print("   ✅ Schema changes committed")
+        
+        # Backfill existing customers only right after the column was added,
+        # so warm starts don't scan the whole table
+        # Runs in batches of BACKFILL_BATCH_SIZE rows, committing each one,
+        # so the table is never locked for the whole backfill
+        if added_customer_type:
+            with engine.connect() as connection:
+                while True:
+                    result = connection.execute(text(
+                        "UPDATE customers SET customer_type = 'in-person' "
+                        "WHERE id IN (SELECT id FROM customers WHERE customer_type IS NULL ORDER BY id LIMIT :batch_size)"
+                    ), {"batch_size": BACKFILL_BATCH_SIZE})
+                    connection.commit()
+                    if result.rowcount == 0:
+                        break
+        
         print("✅ Database schema up to date!")
         
     except Exception as e:
@@ -80,4 +175,5 @@ def auto_migrate():
         pass
 
 if __name__ == "__main__":
-    auto_migrate()
+    from main import app
+    auto_migrate(app)
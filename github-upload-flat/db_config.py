@@ -0,0 +1,22 @@
+"""
+Database URL resolution shared by everything that connects to the database
+"""
+
+import functools
+import os
+
+@functools.lru_cache(maxsize=1)
+def get_database_url():
+    """
+    Return the DATABASE_URL provided by Railway, normalized for SQLAlchemy
+    
+    Returns:
+        str: PostgreSQL URL, or None when DATABASE_URL is not set
+    """
+    database_url = os.environ.get("DATABASE_URL")
+    
+    # Fix for SQLAlchemy 1.4+ which requires postgresql:// instead of postgres://
+    if database_url and database_url.startswith("postgres://"):
+        database_url = database_url.replace("postgres://", "postgresql://", 1)
+    
+    return database_url
@@ -4,147 +4,69 @@ Script to import all services into the database
 Run this script once to populate the SessionType table
 """
 
+import logging
 from main import app
 from db import db
 from models.models import SessionType
+from seed_data import SERVICES, SERVICE_NAMES
 
-# List of all services from QuickBooks
-SERVICES = [
-    {
-        "name": "Absence Motivée",
-        "duration_minutes": 60,
-        "price": 21.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Absence non motivée",
-        "duration_minutes": 60,
-        "price": 21.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Cours annulé",
-        "duration_minutes": 60,
-        "price": 0.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Cours de Batterie",
-        "duration_minutes": 60,
-        "price": 27.00,
-        "category": "Musique"
-    },
-    {
-        "name": "Cours de chant",
-        "duration_minutes": 60,
-        "price": 27.00,
-        "category": "Musique"
-    },
-    {
-        "name": "Cours de Guitare",
-        "duration_minutes": 60,
-        "price": 27.00,
-        "category": "Musique"
-    },
-    {
-        "name": "Cours de piano",
-        "duration_minutes": 60,
-        "price": 27.00,
-        "category": "Musique"
-    },
-    {
-        "name": "Groupe Français",
-        "duration_minutes": 60,
-        "price": 21.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Groupe Mathématiques",
-        "duration_minutes": 60,
-        "price": 21.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Groupe mathématiques et Français",
-        "duration_minutes": 60,
-        "price": 21.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Heures",
-        "duration_minutes": 60,
-        "price": 0.00,
-        "category": "Général"
-    },
-    {
-        "name": "Individuel (En ligne)",
-        "duration_minutes": 60,
-        "price": 40.00,
-        "category": "Tutorat"
-    },
-    {
-        "name": "Individuel (présentiel)",
-        "duration_minutes": 60,
-        "price": 40.00,
-        "category": "Tutorat"
-    }
-]
+log = logging.getLogger(__name__)
 
 def import_services():
     """Import all services into the database"""
     with app.app_context():
-        print("=" * 60)
-        print("IMPORTING SERVICES INTO DATABASE")
-        print("=" * 60)
-        print()
+        log.info("Importing %d services into database...", len(SERVICES))
         
         imported_count = 0
         skipped_count = 0
         updated_count = 0
         
+        # Fetch every already-existing service in a single query
+        existing = {s.name: s for s in SessionType.query.filter(SessionType.name.in_(SERVICE_NAMES)).all()}
+        
+        new_rows = []
+        update_rows = []
+        
         for service_data in SERVICES:
             service_name = service_data["name"]
             
             # Check if service already exists
-            existing_service = SessionType.query.filter_by(name=service_name).first()
+            existing_service = existing.get(service_name)
             
-            if existing_service:
+            if existing_service and (existing_service.duration, existing_service.price) == (service_data["duration"], service_data["price"]):
+                # Already up to date - nothing to write
+                skipped_count += 1
+            elif existing_service:
                 # Update existing service
-                existing_service.duration_minutes = service_data["duration_minutes"]
-                existing_service.price = service_data["price"]
-                print(f"✓ Updated: {service_name} - ${service_data['price']:.2f}")
+                update_rows.append({
+                    "id": existing_service.id,
+                    "duration": service_data["duration"],
+                    "price": service_data["price"]
+                })
                 updated_count += 1
             else:
                 # Create new service
-                new_service = SessionType(
-                    name=service_name,
-                    duration_minutes=service_data["duration_minutes"],
-                    price=service_data["price"]
-                )
-                db.session.add(new_service)
-                print(f"✓ Imported: {service_name} - ${service_data['price']:.2f}")
+                new_rows.append({
+                    "name": service_name,
+                    "duration": service_data["duration"],
+                    "price": service_data["price"]
+                })
                 imported_count += 1
         
-        # Commit all changes
+        # Write all changes in bulk and commit
+        db.session.bulk_update_mappings(SessionType, update_rows)
+        db.session.bulk_insert_mappings(SessionType, new_rows)
         db.session.commit()
         
-        print()
-        print("=" * 60)
-        print("IMPORT COMPLETE!")
-        print("=" * 60)
-        print(f"✓ New services imported: {imported_count}")
-        print(f"✓ Existing services updated: {updated_count}")
-        print(f"✓ Total services in database: {SessionType.query.count()}")
-        print()
+        log.info(
+            "Import complete: %d new, %d updated, %d unchanged, %d total services in database",
+            imported_count, updated_count, skipped_count, SessionType.query.count()
+        )
         
         # Display all services
-        print("=" * 60)
-        print("ALL SERVICES IN DATABASE:")
-        print("=" * 60)
         all_services = SessionType.query.order_by(SessionType.name).all()
         for service in all_services:
-            print(f"  • {service.name} - ${service.price:.2f} ({service.duration_minutes} min)")
-        print()
+            log.info("  • %s - $%.2f (%s min)", service.name, service.price, service.duration)
 
 if __name__ == "__main__":
     import_services()
@@ -0,0 +1,49 @@
+"""
+Logging setup shared by the web app and the maintenance scripts
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+_listener = None
+
+def configure_logging():
+    """
+    Route all logging through a queue drained by a background thread
+
+    Request threads only append records to an in-process queue; a
+    QueueListener thread formats them and writes to stderr, so slow stdout
+    (Railway log shipping) never blocks a request. The level comes from
+    LOG_LEVEL (default INFO), so debug messages cost nothing in production.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    root.addHandler(queue_handler)
+
+    _listener.start()
+    # Drain whatever is still queued when the process exits
+    atexit.register(lambda: _listener.stop())
+
+    # gunicorn --preload forks workers after this runs and threads don't
+    # survive fork: give each worker its own queue and a new listener (the
+    # inherited one has no thread left to stop or restart)
+    def _restart_in_child():
+        global _listener
+        queue_handler.queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+        _listener.start()
+
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -1,5 +1,4 @@
-from routes.session_routes import session_bp
-from auto_migrate import auto_migrate
+from auto_migrate import auto_migrate, migration_lock
 from routes.pages_routes import pages_bp  # Import
 from routes.sessiontype_routes import sessiontype_bp  # Avec les imports
 
@@ -15,6 +14,9 @@ if not os.environ.get("QB_ENVIRONMENT"):
 from flask import Flask, jsonify, send_from_directory
 from flask_cors import CORS
 from db import db
+from db_config import get_database_url
+from logging_config import configure_logging
+from utils.json_provider import init_json_provider
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Try to load environment variables from .env file (optional, will override defaults above)
@@ -24,25 +26,29 @@ try:
 except ImportError:
     pass  # dotenv not available, using environment variables
 
+# Log through a background queue listener; level from LOG_LEVEL (default INFO)
+configure_logging()
+
 # Create Flask app with explicit instance_path to avoid conflicts
 app = Flask(__name__, 
             static_folder="static", 
             static_url_path="/",
             instance_path="/tmp/flask_instance")
-CORS(app)
+# jsonify() and request.get_json() through orjson when it is installed
+init_json_provider(app)
+# ALLOWED_ORIGIN: comma-separated list of frontend origins (defaults to any)
+# max_age lets browsers cache preflight responses for 24h
+CORS(app, origins=os.environ.get("ALLOWED_ORIGIN", "*").split(","), supports_credentials=False, max_age=86400)
 
 # Fix for HTTPS detection behind Railway proxy
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Configure the database - PostgreSQL for Railway
 # Railway automatically provides DATABASE_URL when you add a PostgreSQL database
-database_url = os.environ.get("DATABASE_URL")
+database_url = get_database_url()
 
 if database_url:
     # Railway provides DATABASE_URL - use PostgreSQL
-    # Fix for SQLAlchemy 1.4+ which requires postgresql:// instead of postgres://
-    if database_url.startswith("postgres://"):
-        database_url = database_url.replace("postgres://", "postgresql://", 1)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
     print(f"Using PostgreSQL database")
 else:
@@ -54,14 +60,21 @@ else:
     print(f"Using SQLite database at: {os.path.join(database_path, 'app.db')}")
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Size the connection pool to the gunicorn worker/thread count instead of
+# relying on the default 5 + 10 overflow
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
     "pool_recycle": 300,
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+    "pool_timeout": 30,
+    "pool_use_lifo": True,
 }
 db.init_app(app)
 
 # Import models after db is defined to avoid circular imports
 from models.models import Customer, SessionType, CheckIn, QuickBooksToken
+from seed_data import SERVICES
 
 # Register blueprints
 from routes.customer_routes import customer_bp
@@ -78,7 +91,7 @@ app.register_blueprint(session_bp)
 app.register_blueprint(customer_bp, url_prefix="/api/customers")
 app.register_blueprint(checkin_bp, url_prefix="/api/checkins")
 app.register_blueprint(quickbooks_bp, url_prefix="/api/quickbooks")
-app.register_blueprint(admin_bp, url_prefix="/api/admin")
+app.register_blueprint(admin_bp)
 app.register_blueprint(email_improved_bp, url_prefix="/api/email")
 app.register_blueprint(simple_checkin_bp)
 app.register_blueprint(pages_bp)  # Register
@@ -87,14 +100,17 @@ app.register_blueprint(sessiontype_bp)  # Avec les register_blueprint
 def create_tables_and_initial_data():
     db.create_all()
     # Add initial session types if they don't exist
-    if not SessionType.query.first():
-        initial_session_types = [
-            SessionType(name="French Tutoring", duration=60, price=50.00),
-SessionType(name="Math Tutoring", duration=60, price=45.00),
-SessionType(name="Piano Lesson", duration=30, price=35.00),
-
-        ]
-        db.session.add_all(initial_session_types)
+    # ON CONFLICT DO NOTHING keeps this race-free when several gunicorn
+    # workers boot at the same time against an empty table
+    # Probe a single column so the check doesn't depend on the table
+    # already having every mapped column
+    if db.session.query(SessionType.id).first() is None:
+        if db.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(SessionType.__table__).values(list(SERVICES)).on_conflict_do_nothing(index_elements=["name"])
+        db.session.execute(stmt)
         db.session.commit()
 
 @app.route("/")
@@ -105,11 +121,19 @@ def serve_index():
 def not_found(e):
     return send_from_directory(app.static_folder, "index.html")
 
+# Runs in every gunicorn worker; the lock makes sure only one of them
+# creates tables / migrates at a time
 with app.app_context():
-    create_tables_and_initial_data()
+    with migration_lock(db.engine):
+        # Migrate first: seeding queries the models, which need the columns
+        # added since the database was created. On a fresh database this is
+        # a no-op and create_all() builds the full schema
+        auto_migrate(app)
+        create_tables_and_initial_data()
+    # With gunicorn --preload this runs once in the master process; drop its
+    # pooled connections so forked workers don't share sockets
+    db.engine.dispose()
 
 if __name__ == "__main__":
-        # Run auto-migration on startup
-    auto_migrate()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=False, host="0.0.0.0", port=port)
@@ -1,6 +1,9 @@
 from db import db
 from datetime import datetime
 
+# Bound once so to_dict() avoids a per-row attribute lookup
+_iso = datetime.isoformat
+
 class Customer(db.Model):
     __tablename__ = 'customers'
     
@@ -11,7 +14,8 @@ class Customer(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     address = db.Column(db.String(200))
     customer_type = db.Column(db.String(20), default='in-person')  # 'in-person' or 'remote'
-    qr_code_data = db.Column(db.String(200))
+    qr_code_data = db.Column(db.String(200), unique=True, index=True)  # looked up on every check-in
+    qb_customer_id = db.Column(db.String(50))  # QuickBooks Customer.Id, saved after the first invoice
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     check_ins = db.relationship('CheckIn', backref='customer', lazy=True)
@@ -26,34 +30,52 @@ class Customer(db.Model):
             'address': self.address,
             'customer_type': self.customer_type,
             'qr_code_data': self.qr_code_data,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': _iso(self.created_at) if self.created_at else None
         }
 
 class CheckIn(db.Model):
     __tablename__ = 'check_ins'
+    __table_args__ = (
+        # Covers both "check-ins for a customer" and "... ordered/filtered by time"
+        db.Index('ix_checkins_cust_time', 'customer_id', 'check_in_time'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
-    check_in_time = db.Column(db.DateTime, default=datetime.utcnow)
-    session_type = db.Column(db.String(100))
+    check_in_time = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    session_type = db.Column(db.String(100), index=True)  # joined to session_types.name and filtered on
     notes = db.Column(db.Text)
     qb_invoice_id = db.Column(db.String(50))  # QuickBooks invoice ID
     is_manual = db.Column(db.Boolean, default=False)  # Track if session was manually entered
     
     def to_dict(self):
-        customer = Customer.query.get(self.customer_id)
+        # Uses the relationship so callers can eager-load it with joinedload(CheckIn.customer)
+        customer = self.customer
         return {
             'id': self.id,
             'customer_id': self.customer_id,
-            'customer_name': f"{customer.firstName} {customer.lastName}" if customer else "Unknown",
+            'customer_name': ' '.join((customer.firstName, customer.lastName)) if customer else "Unknown",
             'customer_type': customer.customer_type if customer else "in-person",
-            'check_in_time': self.check_in_time.isoformat() if self.check_in_time else None,
+            'check_in_time': _iso(self.check_in_time) if self.check_in_time else None,
             'session_type': self.session_type,
             'notes': self.notes,
             'qb_invoice_id': self.qb_invoice_id,
             'is_manual': self.is_manual
         }
 
+class CheckInArchive(db.Model):
+    """Check-ins older than the retention window, moved here by archive_checkins.py"""
+    __tablename__ = 'check_ins_archive'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Same id as the original check-in
+    customer_id = db.Column(db.Integer, nullable=False, index=True)
+    check_in_time = db.Column(db.DateTime)
+    session_type = db.Column(db.String(100))
+    notes = db.Column(db.Text)
+    qb_invoice_id = db.Column(db.String(50))
+    is_manual = db.Column(db.Boolean, default=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class SessionType(db.Model):
     __tablename__ = 'session_types'
     
@@ -61,6 +83,7 @@ class SessionType(db.Model):
     name = db.Column(db.String(100), unique=True, nullable=False)
     price = db.Column(db.Float, nullable=False)
     duration = db.Column(db.Integer, default=60)  # in minutes
+    qb_item_id = db.Column(db.String(50))  # QuickBooks Item.Id, saved after the first invoice
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -69,9 +92,16 @@ class SessionType(db.Model):
             'name': self.name,
             'price': self.price,
             'duration': self.duration,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': _iso(self.created_at) if self.created_at else None
         }
 
+class InvoiceCounter(db.Model):
+    """Last invoice number handed out per QuickBooks realm and number prefix"""
+    __tablename__ = 'invoice_counters'
+    
+    key = db.Column(db.String(150), primary_key=True)  # "<realm_id>:<prefix>"
+    last_number = db.Column(db.BigInteger, nullable=False)
+
 class QuickBooksToken(db.Model):
     __tablename__ = 'quickbooks_tokens'
     
@@ -87,7 +117,7 @@ class QuickBooksToken(db.Model):
         return {
             'id': self.id,
             'realm_id': self.realm_id,
-            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'expires_at': _iso(self.expires_at) if self.expires_at else None,
+            'created_at': _iso(self.created_at) if self.created_at else None,
+            'updated_at': _iso(self.updated_at) if self.updated_at else None
         }
@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 from models.models import SessionType
 from db import db
+from seed_data import SERVICES, SERVICE_NAMES
+from utils.service_cache import get_services, invalidate_services
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
 
@@ -9,14 +11,7 @@ admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
 def get_all_services():
     """Get all available services/session types"""
     try:
-        services = SessionType.query.all()
-        return jsonify([{
-            "id": s.id,
-            "name": s.name,
-            "price": s.price,
-            "duration": s.duration,
-            "created_at": s.created_at.isoformat() if s.created_at else None
-        } for s in services]), 200
+        return jsonify(get_services()), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -45,6 +40,7 @@ def add_service():
         
         db.session.add(new_service)
         db.session.commit()
+        invalidate_services()
         
         return jsonify({
             "message": "Service added successfully",
@@ -80,6 +76,7 @@ def update_service(service_id):
             service.duration = int(data['duration'])
         
         db.session.commit()
+        invalidate_services()
         
         return jsonify({
             "message": "Service updated successfully",
@@ -106,6 +103,7 @@ def delete_service(service_id):
         
         db.session.delete(service)
         db.session.commit()
+        invalidate_services()
         
         return jsonify({"message": "Service deleted successfully"}), 200
         
@@ -123,57 +121,18 @@ def import_predefined_services():
     Basé sur: ProductsServicesList_Doulos_Éducation_07_02_2026.csv
     """
     try:
-        # Predefined services list - NOMS QUICKBOOKS EXACTS
-        predefined_services = [
-            # Tutorat individuel (40$)
-            {"name": "Individuel (En ligne)", "duration": 60, "price": 40.00},
-            {"name": "Individuel (présentiel)", "duration": 60, "price": 40.00},  # MODIFIÉ: "En personne" → "présentiel"
-            
-            # Tutorat groupe (21$)
-            {"name": "Groupe (4-5) (En personne)", "duration": 60, "price": 21.00},
-            {"name": "Grand groupe (6+) (En personne)", "duration": 60, "price": 21.00},
-            {"name": "Groupe Français", "duration": 60, "price": 21.00},  # AJOUTÉ
-            {"name": "Groupe Mathématiques", "duration": 60, "price": 21.00},  # AJOUTÉ
-            {"name": "Groupe mathématiques et Français", "duration": 60, "price": 21.00},  # AJOUTÉ
-            
-            # Tutorat sous-groupe (27$)
-            {"name": "Sous groupe (Maths + Francais)", "duration": 60, "price": 27.00},  # AJOUTÉ
-            
-            # Musique (27$) - NOMS MODIFIÉS POUR CORRESPONDRE À QUICKBOOKS
-            {"name": "Cours de piano", "duration": 30, "price": 27.00},  # MODIFIÉ: "Piano" → "Cours de piano"
-            {"name": "Cours de Guitare", "duration": 30, "price": 27.00},  # MODIFIÉ: "Guitare" → "Cours de Guitare"
-            {"name": "Cours de chant", "duration": 30, "price": 27.00},  # MODIFIÉ: "Chant" → "Cours de chant"
-            {"name": "Cours de Batterie", "duration": 30, "price": 27.00},  # MODIFIÉ: "Batterie" → "Cours de Batterie"
-            
-            # Absences (21$)
-            {"name": "Absence Motivée", "duration": 60, "price": 21.00},  # AJOUTÉ
-            {"name": "Absence non motivée", "duration": 60, "price": 21.00},  # AJOUTÉ
-            
-            # Spéciaux (0$)
-            {"name": "Cours annulé", "duration": 60, "price": 0.00},  # AJOUTÉ
-            {"name": "Heures", "duration": 60, "price": 0.00}
-        ]
-        
-        imported_count = 0
-        skipped_count = 0
-        
-        for service_data in predefined_services:
-            # Check if service already exists
-            existing_service = SessionType.query.filter_by(name=service_data["name"]).first()
-            if existing_service:
-                skipped_count += 1
-                continue
-            
-            # Create new service
-            new_service = SessionType(
-                name=service_data["name"],
-                duration=service_data["duration"],
-                price=service_data["price"]
-            )
-            db.session.add(new_service)
-            imported_count += 1
+        # Fetch the names of already-existing services in a single query
+        existing = {name for (name,) in db.session.query(SessionType.name).filter(SessionType.name.in_(SERVICE_NAMES))}
         
+        new_rows = [dict(service_data) for service_data in SERVICES if service_data["name"] not in existing]
+        skipped_count = len(SERVICES) - len(new_rows)
+        imported_count = len(new_rows)
+        
+        # Single multi-row INSERT for every missing service
+        if new_rows:
+            db.session.execute(SessionType.__table__.insert(), new_rows)
         db.session.commit()
+        invalidate_services()
         
         return jsonify({
             "message": f"Import completed: {imported_count} services imported, {skipped_count} skipped (already exist)",
@@ -1,14 +1,27 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from db import db
 from models.models import CheckIn, Customer, SessionType
 from datetime import datetime
-import requests
+import calendar
 import os
 import re
-from utils.token_storage import load_token_from_file, is_token_valid, get_valid_token
-from urllib.parse import urlparse, parse_qs
+import logging
+from urllib.parse import unquote_plus
+from utils.token_storage import get_cached_token
+from utils.qb_http import qb_session, qbo_escape, qb_json, qb_headers, qb_batch, resolve_qb_refs, qb_invalid_refs, QuickBooksInvalidRef, QuickBooksUnavailable
+from utils.qb_cache import get_cached_ref, cache_ref, forget_ref, QB_INVOICE_CACHE_TTL
+from utils.service_cache import get_service, get_services
+from utils.invoice_counter import claim_invoice_number, release_invoice_number, next_invoice_number
+from utils.invoice_lock import lock_monthly_invoice
+from sqlalchemy import insert, tuple_
+from requests.exceptions import ConnectTimeout
+from concurrent.futures import ThreadPoolExecutor
 
 checkin_bp = Blueprint("checkin_bp", __name__)
+log = logging.getLogger(__name__)
+
+# Largest page get_checkins will return when ?limit is given
+MAX_PAGE_SIZE = 500
 
 # QuickBooks Configuration
 QB_ENVIRONMENT = os.environ.get("QB_ENVIRONMENT", "sandbox")
@@ -17,6 +30,19 @@ if QB_ENVIRONMENT == "production":
 else:
     QB_API_URL = "https://sandbox-quickbooks.api.intuit.com"
 
+# QBO query templates - values are escaped with qbo_escape() before formatting.
+# Only the fields the helpers actually read are selected
+_QUERY_LAST_INVOICE = "SELECT DocNumber FROM Invoice ORDERBY DocNumber DESC MAXRESULTS 1"
+_QUERY_MONTHLY_INVOICE = "SELECT Id, SyncToken, Line FROM Invoice WHERE CustomerRef = '{}' AND TxnDate >= '{}' AND TxnDate <= '{}' AND Balance > '0' MAXRESULTS 1"
+
+# "qr=<code>" at the start of the value or as a URL query parameter. The
+# capture is still percent-encoded - decode it with unquote_plus() like
+# parse_qs() would
+_QR_PARAM_RE = re.compile(r"(?:^|[?&])qr=([^&#]*)")
+
+# Worker that creates invoices after the check-in response has been sent
+_qb_background = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qb-invoice")
+
 def extract_qr_code_from_value(qr_value):
     """
     Extract the actual QR code UUID from various possible formats
@@ -25,6 +51,7 @@ def extract_qr_code_from_value(qr_value):
     1. Direct UUID: "a1b2c3d4-e5f6-7890-abcd-ef1234567890"
     2. URL with qr parameter: "https://domain.com/checkin?qr=a1b2c3d4-e5f6-7890-abcd-ef1234567890"
     3. Just the qr parameter: "qr=a1b2c3d4-e5f6-7890-abcd-ef1234567890"
+    4. "qr=" anywhere else in the value: "checkin;qr=a1b2c3d4-e5f6-7890-abcd-ef1234567890"
     
     Returns:
         str: The extracted UUID
@@ -32,36 +59,29 @@ def extract_qr_code_from_value(qr_value):
     if not qr_value:
         return None
     
-    # If it's already a clean UUID (no URL parts), return as-is
-    if '://' not in qr_value and '=' not in qr_value:
-        print(f"[QR_EXTRACT] Direct UUID detected: {qr_value}")
+    # The scanner almost always sends the bare UUID: its length and dash
+    # positions identify it without scanning the string
+    if len(qr_value) == 36 and qr_value[8] == qr_value[13] == qr_value[18] == qr_value[23] == "-":
+        return qr_value
+
+    # Anything else without a qr parameter is used as-is too
+    if "qr=" not in qr_value:
+        log.debug("[QR_EXTRACT] Direct value: %s", qr_value)
         return qr_value
     
-    # If it contains a URL, parse it
-    if '://' in qr_value:
-        try:
-            parsed = urlparse(qr_value)
-            query_params = parse_qs(parsed.query)
-            
-            if 'qr' in query_params:
-                extracted = query_params['qr'][0]
-                print(f"[QR_EXTRACT] Extracted from URL: {qr_value} → {extracted}")
-                return extracted
-        except Exception as e:
-            print(f"[QR_EXTRACT] Error parsing URL: {str(e)}")
-    
-    # If it's in format "qr=value"
-    if '=' in qr_value and 'qr=' in qr_value:
-        try:
-            extracted = qr_value.split('qr=')[1].split('&')[0]
-            print(f"[QR_EXTRACT] Extracted from parameter: {qr_value} → {extracted}")
-            return extracted
-        except Exception as e:
-            print(f"[QR_EXTRACT] Error parsing parameter: {str(e)}")
+    # One scan finds the qr parameter whether the scanner sent a full URL or
+    # just "qr=..."
+    match = _QR_PARAM_RE.search(qr_value)
+    if match:
+        qr_code = unquote_plus(match.group(1))
+        log.debug("[QR_EXTRACT] Extracted: %s → %s", qr_value, qr_code)
+        return qr_code
     
-    # Fallback: return original value
-    print(f"[QR_EXTRACT] No extraction needed, using original: {qr_value}")
-    return qr_value
+    # "qr=" in the middle of the value (e.g. "checkin;qr=..." or a fragment):
+    # take what follows it, as the old split-based parser did
+    qr_code = qr_value.split("qr=", 1)[1].split("&", 1)[0]
+    log.debug("[QR_EXTRACT] Extracted from parameter: %s → %s", qr_value, qr_code)
+    return qr_code
 
 def get_next_invoice_number(access_token, realm_id):
     """
@@ -79,72 +99,24 @@ def get_next_invoice_number(access_token, realm_id):
     """
     try:
         # Query for the most recent invoice
-        query = "SELECT * FROM Invoice ORDERBY DocNumber DESC MAXRESULTS 1"
+        query = _QUERY_LAST_INVOICE
         
-        print(f"[INVOICE_NUMBER] Querying QuickBooks for last invoice number...")
+        log.debug("[INVOICE_NUMBER] Querying QuickBooks for last invoice number")
         
-        response = requests.get(
+        response = qb_session.get(
             f"{QB_API_URL}/v3/company/{realm_id}/query",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json"
-            },
+            headers=qb_headers(access_token),
             params={"query": query}
         )
         
+        invoices = []
         if response.status_code == 200:
-            query_response = response.json().get('QueryResponse', {})
-            invoices = query_response.get('Invoice', [])
-            
-            if invoices and len(invoices) > 0:
-                last_doc_number = invoices[0].get('DocNumber')
-                print(f"[INVOICE_NUMBER] Last invoice number found: {last_doc_number}")
-                
-                # Try to extract numeric part and increment
-                if last_doc_number:
-                    # Format 1: Pure number (e.g., "1001")
-                    if last_doc_number.isdigit():
-                        next_number = int(last_doc_number) + 1
-                        print(f"[INVOICE_NUMBER] Generated next number: {next_number}")
-                        return str(next_number)
-                    
-                    # Format 2: Prefix with dash (e.g., "INV-1001")
-                    if '-' in last_doc_number:
-                        parts = last_doc_number.split('-')
-                        if len(parts) >= 2 and parts[-1].isdigit():
-                            prefix = '-'.join(parts[:-1])
-                            next_number = int(parts[-1]) + 1
-                            result = f"{prefix}-{next_number}"
-                            print(f"[INVOICE_NUMBER] Generated next number: {result}")
-                            return result
-                    
-                    # Format 3: Try to find any number at the end
-                    match = re.search(r'(\d+)$', last_doc_number)
-                    if match:
-                        number_part = match.group(1)
-                        prefix = last_doc_number[:match.start()]
-                        next_number = int(number_part) + 1
-                        # Preserve leading zeros
-                        formatted_number = str(next_number).zfill(len(number_part))
-                        result = f"{prefix}{formatted_number}"
-                        print(f"[INVOICE_NUMBER] Generated next number: {result}")
-                        return result
-        
-        # Fallback: Generate based on date/time
-        now = datetime.now()
-        date_prefix = now.strftime("%Y%m%d")
-        time_suffix = now.strftime("%H%M%S")
-        invoice_number = f"{date_prefix}-{time_suffix}"
-        print(f"[INVOICE_NUMBER] Generated fallback number: {invoice_number}")
-        return invoice_number
+            invoices = qb_json(response).get('QueryResponse', {}).get('Invoice', [])
+        return next_invoice_number(invoices[0].get('DocNumber') if invoices else None)
         
     except Exception as e:
-        print(f"[INVOICE_NUMBER] Error getting next invoice number: {str(e)}")
-        # Fallback: Generate based on timestamp
-        now = datetime.now()
-        invoice_number = now.strftime("%Y%m%d-%H%M%S")
-        print(f"[INVOICE_NUMBER] Using timestamp fallback: {invoice_number}")
-        return invoice_number
+        log.warning("[INVOICE_NUMBER] Error getting next invoice number: %s", e)
+        return next_invoice_number(None)
 
 def create_or_update_monthly_invoice(customer, session_type, checkin_id, checkin_date):
     """Create a new invoice or update existing monthly invoice for a customer"""
@@ -152,113 +124,178 @@ def create_or_update_monthly_invoice(customer, session_type, checkin_id, checkin
         # ✅ FIXED: Use get_valid_token() which automatically refreshes if expired
         # This replaces the old pattern of load_token_from_file() + is_token_valid()
         # which would skip invoice creation instead of retrying after refresh
-        token_data = get_valid_token()
+        token_data = get_cached_token()
         if not token_data or not token_data.get('access_token'):
-            print("[QUICKBOOKS] Not connected to QuickBooks or unable to refresh token - skipping invoice creation")
+            log.info("[QUICKBOOKS] Not connected to QuickBooks or unable to refresh token - skipping invoice creation")
             return None
         
         realm_id = token_data.get('realm_id')
         access_token = token_data.get('access_token')
         
-        print(f"[QUICKBOOKS] Token valid, proceeding with invoice creation...")
+        log.debug("[QUICKBOOKS] Token valid, proceeding with invoice creation")
         
-        print(f"[QUICKBOOKS] Processing invoice for customer: {customer.firstName} {customer.lastName}")
+        log.debug("[QUICKBOOKS] Processing invoice for customer: %s %s", customer.firstName, customer.lastName)
+        
+        # Steps 1 & 2: Find or create the customer and the service item in QuickBooks
+        # (cached refs first, then at most one batch query + one batch create)
+        customer_ref, item_ref = resolve_qb_refs(customer, session_type, access_token, realm_id, QB_API_URL)
         
-        # Step 1: Find or create customer in QuickBooks
-        customer_ref = find_or_create_qb_customer(customer, access_token, realm_id)
         if not customer_ref:
-            print("[QUICKBOOKS] Failed to find/create customer")
+            log.warning("[QUICKBOOKS] Failed to find/create customer")
             return None
         
-        # Step 2: Find or create service item in QuickBooks
-        item_ref = find_or_create_qb_item(session_type, access_token, realm_id)
         if not item_ref:
-            print("[QUICKBOOKS] Failed to find/create service item")
+            log.warning("[QUICKBOOKS] Failed to find/create service item")
             return None
         
         # Step 3: Check if there's an existing invoice for this customer in the same month
-        existing_invoice = find_monthly_invoice(customer_ref, checkin_date, access_token, realm_id)
-        
-        if existing_invoice:
-            # Update existing invoice by adding a new line
-            print(f"[QUICKBOOKS] Found existing invoice for this month: ID {existing_invoice['Id']}")
-            updated_invoice_id = add_line_to_invoice(existing_invoice, item_ref, session_type, checkin_id, access_token, realm_id)
-            return updated_invoice_id
+        # (the same batch fetches the last DocNumber in case a new invoice is needed)
+        invoice_key = (realm_id, "Invoice", customer_ref['value'], checkin_date.year, checkin_date.month)
+        existing_invoice = get_cached_ref(invoice_key)
+        from_cache = existing_invoice is not None
+        if from_cache:
+            log.debug("[QUICKBOOKS] ✓ Using recently written invoice: ID %s", existing_invoice['Id'])
+            invoice_number = None
         else:
-            # Create new invoice
-            print(f"[QUICKBOOKS] No existing invoice for this month - creating new invoice")
-            new_invoice_id = create_new_invoice(customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id)
-            return new_invoice_id
+            existing_invoice, invoice_number = find_monthly_invoice(customer_ref, checkin_date, access_token, realm_id)
+        
+        try:
+            invoice_id = write_monthly_invoice(existing_invoice, invoice_number, customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id, invoice_key)
+            
+            if not invoice_id and from_cache:
+                # The cached copy went stale (changed by a manual session, another
+                # worker or in QuickBooks itself) - fetch the invoice and retry once
+                log.info("[QUICKBOOKS] Cached invoice was out of date - fetching it again")
+                existing_invoice, invoice_number = find_monthly_invoice(customer_ref, checkin_date, access_token, realm_id)
+                invoice_id = write_monthly_invoice(existing_invoice, invoice_number, customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id, invoice_key)
+        except QuickBooksInvalidRef as e:
+            # The saved/cached customer or item was deleted in QuickBooks -
+            # forget it so the next check-in looks it up again. Other failures
+            # (stale SyncToken, 5xx, open circuit) keep the IDs
+            log.warning("[QUICKBOOKS] %s", e)
+            if "Customer" in e.entities:
+                forget_ref((realm_id, "Customer", customer_ref["name"]))
+                customer.qb_customer_id = None
+            if "Item" in e.entities:
+                forget_ref((realm_id, "Item", item_ref["name"]))
+                session_type.qb_item_id = None
+            return None
+        
+        return invoice_id
             
     except Exception as e:
-        print(f"[QUICKBOOKS] Error processing invoice: {str(e)}")
+        log.exception("[QUICKBOOKS] Error processing invoice: %s", e)
         return None
 
+def _month_bounds(year, month):
+    """Return the first and last day of a month as QBO date strings"""
+    return f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{calendar.monthrange(year, month)[1]:02d}"
+
 def find_monthly_invoice(customer_ref, checkin_date, access_token, realm_id):
-    """Find an existing unpaid invoice for the customer in the same month/year"""
+    """
+    Find an existing unpaid invoice for the customer in the same month/year
+    
+    The last invoice's DocNumber is fetched in the same batch request, so
+    creating a new invoice doesn't need another round trip to number it.
+    Always asks QuickBooks - the caller checks the invoice cache first.
+    
+    Returns:
+        tuple: (invoice or None, next invoice number or None if unknown)
+    """
     try:
         # Get the first and last day of the month
         year = checkin_date.year
         month = checkin_date.month
-        first_day = f"{year}-{month:02d}-01"
-        
-        # Calculate last day of month
-        if month == 12:
-            last_day = f"{year}-12-31"
-        else:
-            import calendar
-            last_day_num = calendar.monthrange(year, month)[1]
-            last_day = f"{year}-{month:02d}-{last_day_num:02d}"
+        first_day, last_day = _month_bounds(year, month)
         
         # Query for invoices for this customer in this month
         customer_id = customer_ref['value']
-        query = f"SELECT * FROM Invoice WHERE CustomerRef = '{customer_id}' AND TxnDate >= '{first_day}' AND TxnDate <= '{last_day}' AND Balance > '0'"
-        
-        print(f"[QUICKBOOKS] Searching for existing invoice: {query}")
-        
-        response = requests.get(
-            f"{QB_API_URL}/v3/company/{realm_id}/query",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json"
-            },
-            params={"query": query}
-        )
-        
-        if response.status_code == 200:
-            query_response = response.json().get("QueryResponse", {})
-            invoices = query_response.get("Invoice", [])
-            
-            if invoices:
-                # Return the first unpaid invoice found
-                invoice = invoices[0]
-                print(f"[QUICKBOOKS] ✓ Found existing invoice: ID {invoice['Id']} for {year}-{month:02d}")
-                return invoice
-        
-        print(f"[QUICKBOOKS] No existing invoice found for {year}-{month:02d}")
-        return None
+        query = _QUERY_MONTHLY_INVOICE.format(qbo_escape(customer_id), first_day, last_day)
+        
+        log.debug("[QUICKBOOKS] Searching for existing invoice: %s", query)
+        
+        results = qb_batch([
+            {"bId": "MonthlyInvoice", "Query": query},
+            {"bId": "LastInvoice", "Query": _QUERY_LAST_INVOICE}
+        ], access_token, realm_id, QB_API_URL)
+        if results is None:
+            return None, None
+        
+        invoices = results.get("MonthlyInvoice", {}).get("QueryResponse", {}).get("Invoice", [])
+        if invoices:
+            # Return the first unpaid invoice found
+            invoice = invoices[0]
+            log.debug("[QUICKBOOKS] ✓ Found existing invoice: ID %s for %d-%02d", invoice['Id'], year, month)
+            return invoice, None
+        
+        log.debug("[QUICKBOOKS] No existing invoice found for %d-%02d", year, month)
+        last_response = results.get("LastInvoice", {})
+        if "QueryResponse" not in last_response:
+            return None, None  # numbering query failed - create_new_invoice asks again
+        last_invoices = last_response["QueryResponse"].get("Invoice", [])
+        return None, next_invoice_number(last_invoices[0].get("DocNumber") if last_invoices else None)
             
     except Exception as e:
-        print(f"[QUICKBOOKS] Error finding monthly invoice: {str(e)}")
-        return None
+        log.warning("[QUICKBOOKS] Error finding monthly invoice: %s", e)
+        return None, None
+
+def write_monthly_invoice(existing_invoice, invoice_number, customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id, cache_key=None):
+    """
+    Add the check-in to the month's invoice, or create that invoice
+
+    Returns:
+        str: QuickBooks invoice ID, or None if the write failed
+    """
+    if existing_invoice:
+        # Update existing invoice by adding a new line
+        log.debug("[QUICKBOOKS] Found existing invoice for this month: ID %s", existing_invoice['Id'])
+        return add_line_to_invoice(existing_invoice, item_ref, session_type, checkin_id, access_token, realm_id, cache_key)
+    
+    # Create new invoice
+    log.debug("[QUICKBOOKS] No existing invoice for this month - creating new invoice")
+    return create_new_invoice(customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id, invoice_number, cache_key)
+
+def _cache_invoice(cache_key, invoice):
+    """Remember the Id/SyncToken/Line of an invoice we just wrote"""
+    # Without its lines the next update would wipe the invoice, so only a
+    # complete copy is cached
+    if cache_key and invoice.get("Id") and "SyncToken" in invoice and "Line" in invoice:
+        cache_ref(cache_key, {
+            "Id": invoice["Id"],
+            "SyncToken": invoice["SyncToken"],
+            "Line": invoice["Line"]
+        }, ttl=QB_INVOICE_CACHE_TTL)
 
-def add_line_to_invoice(existing_invoice, item_ref, session_type, checkin_id, access_token, realm_id):
-    """Add a new line item to an existing invoice"""
+def add_line_to_invoice(existing_invoice, item_ref, session_type, checkin_id, access_token, realm_id, cache_key=None):
+    """
+    Add a new line item to an existing invoice
+    
+    Raises:
+        QuickBooksInvalidRef: QuickBooks rejected the item (or the invoice's
+            customer) as deleted/invalid
+    """
+    invalid = None
     try:
         invoice_id = existing_invoice['Id']
         sync_token = existing_invoice['SyncToken']
         
-        # Get existing lines
-        existing_lines = existing_invoice.get('Line', [])
+        # Get existing lines. QuickBooks replaces the whole Line array on update,
+        # so every existing line must be sent back - but the subtotal line is
+        # computed server-side and can be left out of the payload
+        existing_lines = [
+            line for line in existing_invoice.get('Line', [])
+            if line.get('DetailType') != 'SubTotalLineDetail'
+        ]
         
         # Create new line
+        price = float(session_type.price)
         new_line = {
-            "Amount": float(session_type.price),
+            "Amount": price,
             "DetailType": "SalesItemLineDetail",
             "SalesItemLineDetail": {
                 "ItemRef": item_ref,
                 "Qty": 1,
-                "UnitPrice": float(session_type.price)
+                "UnitPrice": price
             },
             "Description": f"{session_type.name} - Check-in #{checkin_id}"
         }
@@ -274,231 +311,200 @@ def add_line_to_invoice(existing_invoice, item_ref, session_type, checkin_id, ac
             "sparse": True  # Only update specified fields
         }
         
-        print(f"[QUICKBOOKS] Adding line to invoice {invoice_id}: {session_type.name} - ${session_type.price}")
+        log.debug("[QUICKBOOKS] Adding line to invoice %s: %s - $%s", invoice_id, session_type.name, session_type.price)
         
-        response = requests.post(
+        response = qb_session.post(
             f"{QB_API_URL}/v3/company/{realm_id}/invoice",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            },
+            headers=qb_headers(access_token),
             json=update_data
         )
         
         if response.status_code in [200, 201]:
-            updated_invoice = response.json().get("Invoice", {})
-            print(f"[QUICKBOOKS] ✓ Line added successfully to invoice {invoice_id}")
+            updated_invoice = qb_json(response).get("Invoice", {})
+            _cache_invoice(cache_key, updated_invoice)
+            log.info("[QUICKBOOKS] ✓ Line added successfully to invoice %s", invoice_id)
             return invoice_id
         else:
-            print(f"[QUICKBOOKS] Failed to update invoice: {response.status_code} - {response.text}")
-            return None
+            log.warning("[QUICKBOOKS] Failed to update invoice: %s - %s", response.status_code, response.text)
+            invalid = qb_invalid_refs(response)
             
     except Exception as e:
-        print(f"[QUICKBOOKS] Error adding line to invoice: {str(e)}")
-        return None
+        log.warning("[QUICKBOOKS] Error adding line to invoice: %s", e)
+    
+    # The cached copy may be stale (paid, edited or deleted in QuickBooks)
+    if cache_key:
+        forget_ref(cache_key)
+    if invalid:
+        raise QuickBooksInvalidRef(invalid)
+    return None
 
-def create_new_invoice(customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id):
+def create_new_invoice(customer_ref, item_ref, session_type, checkin_id, checkin_date, access_token, realm_id, invoice_number=None, cache_key=None):
     """
     Create a new invoice
     
     ✅ NOUVEAU: Génère automatiquement un numéro de facture unique
+    (unless the caller already worked it out, see find_monthly_invoice)
+    
+    Raises:
+        QuickBooksInvalidRef: QuickBooks rejected the customer or item as
+            deleted/invalid
     """
+    invalid = None
+    claimed = None
     try:
         # ✅ NOUVEAU: Générer le numéro de facture automatiquement
-        invoice_number = get_next_invoice_number(access_token, realm_id)
-        print(f"[QUICKBOOKS] Creating invoice with DocNumber: {invoice_number}")
-        
+        if not invoice_number:
+            invoice_number = get_next_invoice_number(access_token, realm_id)
+        invoice_number = claimed = claim_invoice_number(realm_id, invoice_number)
+        log.debug("[QUICKBOOKS] Creating invoice with DocNumber: %s", invoice_number)
+        
+        price = float(session_type.price)
+        # Same day for TxnDate and DueDate, formatted once
+        txn_date = f"{checkin_date.year:04d}-{checkin_date.month:02d}-{checkin_date.day:02d}"
         invoice_data = {
             "DocNumber": invoice_number,  # ✅ AJOUTÉ: Numéro de facture automatique
             "Line": [{
-                "Amount": float(session_type.price),
+                "Amount": price,
                 "DetailType": "SalesItemLineDetail",
                 "SalesItemLineDetail": {
                     "ItemRef": item_ref,
                     "Qty": 1,
-                    "UnitPrice": float(session_type.price)
+                    "UnitPrice": price
                 },
                 "Description": f"{session_type.name} - Check-in #{checkin_id}"
             }],
             "CustomerRef": customer_ref,
-            "TxnDate": checkin_date.strftime("%Y-%m-%d"),
-            "DueDate": checkin_date.strftime("%Y-%m-%d")
+            "TxnDate": txn_date,
+            "DueDate": txn_date
         }
         
-        print(f"[QUICKBOOKS] Creating new invoice for {checkin_date.strftime('%Y-%m')}")
+        log.debug("[QUICKBOOKS] Creating new invoice for %d-%02d", checkin_date.year, checkin_date.month)
         
-        response = requests.post(
+        response = qb_session.post(
             f"{QB_API_URL}/v3/company/{realm_id}/invoice",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            },
+            headers=qb_headers(access_token),
             json=invoice_data
         )
         
         if response.status_code in [200, 201]:
-            invoice = response.json().get("Invoice", {})
+            invoice = qb_json(response).get("Invoice", {})
             invoice_id = invoice.get("Id")
             doc_number = invoice.get("DocNumber", invoice_number)
-            print(f"[QUICKBOOKS] ✓ New invoice created successfully! ID: {invoice_id}, DocNumber: {doc_number}")
+            _cache_invoice(cache_key, invoice)
+            log.info("[QUICKBOOKS] ✓ New invoice created successfully! ID: %s, DocNumber: %s", invoice_id, doc_number)
             return invoice_id
         else:
-            print(f"[QUICKBOOKS] Failed to create invoice: {response.status_code} - {response.text}")
-            return None
+            log.warning("[QUICKBOOKS] Failed to create invoice: %s - %s", response.status_code, response.text)
+            invalid = qb_invalid_refs(response)
+            release_invoice_number(realm_id, claimed)
             
+    except (QuickBooksUnavailable, ConnectTimeout) as e:
+        # The request never reached QuickBooks, so the number is still free
+        log.warning("[QUICKBOOKS] Error creating invoice: %s", e)
+        if claimed:
+            release_invoice_number(realm_id, claimed)
     except Exception as e:
-        print(f"[QUICKBOOKS] Error creating invoice: {str(e)}")
-        return None
+        # Other errors (e.g. a read timeout) may have created the invoice
+        # anyway - keep the number rather than risk handing it out twice
+        log.warning("[QUICKBOOKS] Error creating invoice: %s", e)
+    
+    if invalid:
+        raise QuickBooksInvalidRef(invalid)
+    return None
 
-def find_or_create_qb_customer(customer, access_token, realm_id):
-    """Find existing customer in QuickBooks or create new one"""
-    try:
-        # Search for existing customer by display name
-        customer_name = f"{customer.firstName} {customer.lastName}"
-        query = f"SELECT * FROM Customer WHERE DisplayName = '{customer_name}'"
-        
-        print(f"[QUICKBOOKS] Searching for customer: {customer_name}")
-        
-        response = requests.get(
-            f"{QB_API_URL}/v3/company/{realm_id}/query",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json"
-            },
-            params={"query": query}
-        )
-        
-        if response.status_code == 200:
-            query_response = response.json().get("QueryResponse", {})
-            customers = query_response.get("Customer", [])
-            
-            if customers:
-                customer_id = customers[0].get("Id")
-                print(f"[QUICKBOOKS] Found existing customer: {customer_name} (ID: {customer_id})")
-                return {"value": customer_id, "name": customer_name}
-        
-        # Customer not found, create new one
-        print(f"[QUICKBOOKS] Customer not found, creating new: {customer_name}")
-        
-        customer_data = {
-            "DisplayName": customer_name,
-            "GivenName": customer.firstName,
-            "FamilyName": customer.lastName,
-            "PrimaryEmailAddr": {"Address": customer.email} if customer.email else None,
-            "PrimaryPhone": {"FreeFormNumber": customer.phone} if customer.phone else None
-        }
-        
-        # Remove None values
-        customer_data = {k: v for k, v in customer_data.items() if v is not None}
-        
-        response = requests.post(
-            f"{QB_API_URL}/v3/company/{realm_id}/customer",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            },
-            json=customer_data
-        )
-        
-        if response.status_code in [200, 201]:
-            new_customer = response.json().get("Customer", {})
-            customer_id = new_customer.get("Id")
-            print(f"[QUICKBOOKS] ✓ Customer created: {customer_name} (ID: {customer_id})")
-            return {"value": customer_id, "name": customer_name}
-        else:
-            print(f"[QUICKBOOKS] Failed to create customer: {response.status_code} - {response.text}")
-            return None
+def process_checkin_invoice(app, checkin_id, customer_id, session_type_id):
+    """
+    Background job: create or update the QuickBooks invoice for a check-in
+    
+    Runs outside the request, so the rows are re-loaded in a fresh app context
+    and the resulting invoice ID is saved on the check-in.
+    
+    Args:
+        app (Flask): Application to push a context for
+        checkin_id (int): ID of the committed check-in
+        customer_id (int): ID of the checked-in customer
+        session_type_id (int): ID of the session type
+    """
+    # Not connected to QuickBooks: nothing to do, so don't even load the rows
+    if not get_cached_token():
+        log.info("[CHECK-IN] ⚠ QuickBooks invoice not created (may not be connected)")
+        return
+    
+    with app.app_context():
+        try:
+            checkin = db.session.get(CheckIn, checkin_id)
+            customer = db.session.get(Customer, customer_id)
+            session_type = db.session.get(SessionType, session_type_id)
+            if not (checkin and customer and session_type):
+                log.warning("[CHECK-IN] ⚠ Check-in %s no longer exists - skipping invoice", checkin_id)
+                return
             
-    except Exception as e:
-        print(f"[QUICKBOOKS] Error finding/creating customer: {str(e)}")
-        return None
-
-def find_or_create_qb_item(session_type, access_token, realm_id):
-    """Find existing service item in QuickBooks or create new one"""
-    try:
-        # Search for existing item by name
-        item_name = session_type.name
-        query = f"SELECT * FROM Item WHERE Name = '{item_name}'"
-        
-        print(f"[QUICKBOOKS] Searching for item: {item_name}")
-        
-        response = requests.get(
-            f"{QB_API_URL}/v3/company/{realm_id}/query",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json"
-            },
-            params={"query": query}
-        )
-        
-        if response.status_code == 200:
-            query_response = response.json().get("QueryResponse", {})
-            items = query_response.get("Item", [])
+            # Held until the commit below, so concurrent check-ins for this
+            # customer and month add to one invoice instead of creating two
+            lock_monthly_invoice(customer.id, checkin.check_in_time)
             
-            if items:
-                item_id = items[0].get("Id")
-                print(f"[QUICKBOOKS] Found existing item: {item_name} (ID: {item_id})")
-                return {"value": item_id, "name": item_name}
-        
-        # Item not found, create new one
-        print(f"[QUICKBOOKS] Item not found, creating new: {item_name}")
-        
-        item_data = {
-            "Name": item_name,
-            "Type": "Service",
-            "IncomeAccountRef": {
-                "value": "1"  # Default income account - should be configured
-            },
-            "UnitPrice": float(session_type.price)
-        }
-        
-        response = requests.post(
-            f"{QB_API_URL}/v3/company/{realm_id}/item",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            },
-            json=item_data
-        )
-        
-        if response.status_code in [200, 201]:
-            new_item = response.json().get("Item", {})
-            item_id = new_item.get("Id")
-            print(f"[QUICKBOOKS] ✓ Item created: {item_name} (ID: {item_id})")
-            return {"value": item_id, "name": item_name}
-        else:
-            print(f"[QUICKBOOKS] Failed to create item: {response.status_code} - {response.text}")
-            return None
+            invoice_id = create_or_update_monthly_invoice(customer, session_type, checkin.id, checkin.check_in_time)
             
-    except Exception as e:
-        print(f"[QUICKBOOKS] Error finding/creating item: {str(e)}")
-        return None
+            if invoice_id:
+                checkin.qb_invoice_id = str(invoice_id)
+                log.info("[CHECK-IN] ✓ QuickBooks invoice processed: %s", invoice_id)
+            else:
+                log.info("[CHECK-IN] ⚠ QuickBooks invoice not created (may not be connected)")
+            # Also saves the QuickBooks IDs set (or cleared) on the customer/session type
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.exception("[CHECK-IN] Error processing invoice for check-in %s: %s", checkin_id, e)
 
 @checkin_bp.route("/", methods=["GET"])
 def get_checkins():
-    """Get all check-ins with customer and session type details"""
+    """
+    Get all check-ins with customer and session type details
+
+    Without ?limit the full list is returned, as before. With ?limit=N the
+    response is one page: {"checkins": [...], "next_cursor": {...}}, and the
+    next page is fetched with ?limit=N&before_time=...&before_id=... taken
+    from next_cursor (null on the last page).
+    """
     try:
         # Get query parameters for filtering
         customer_id = request.args.get("customer_id")
         session_type_id = request.args.get("session_type_id")
         start_date = request.args.get("start_date")
         end_date = request.args.get("end_date")
-        
-        # Build query
-        query = CheckIn.query
-        
+        limit = request.args.get("limit")
+        before_time = request.args.get("before_time")
+        before_id = request.args.get("before_id")
+
+        if limit is not None:
+            try:
+                limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+            except ValueError:
+                return jsonify({"error": "limit must be an integer"}), 400
+        
+        # Build query - one JOIN with customers, selecting only the columns
+        # the response needs (plain rows, no ORM objects to hydrate)
+        query = db.session.query(
+            CheckIn.id,
+            CheckIn.customer_id,
+            CheckIn.session_type,
+            CheckIn.check_in_time,
+            CheckIn.notes,
+            CheckIn.qb_invoice_id,
+            Customer.firstName,
+            Customer.lastName,
+            Customer.email
+        ).outerjoin(Customer, Customer.id == CheckIn.customer_id)
+
         if customer_id:
-            query = query.filter_by(customer_id=customer_id)
-        
+            query = query.filter(CheckIn.customer_id == customer_id)
+
         if session_type_id:
             # session_type is stored as string name, need to get the name from ID
-            st = SessionType.query.get(session_type_id)
+            # (from the service cache, so the whole request stays one query)
+            st = get_service(session_type_id)
             if st:
-                query = query.filter_by(session_type=st.name)
+                query = query.filter(CheckIn.session_type == st["name"])
         
         if start_date:
             try:
@@ -514,31 +520,71 @@ def get_checkins():
             except ValueError:
                 pass
         
-        # Order by most recent first
-        checkins = query.order_by(CheckIn.check_in_time.desc()).all()
-        
+        if before_time and before_id:
+            # Keyset pagination: rows strictly after the cursor in
+            # (check_in_time DESC, id DESC) order, so deep pages stay as
+            # cheap as the first one
+            try:
+                cursor = (datetime.fromisoformat(before_time), int(before_id))
+            except ValueError:
+                return jsonify({"error": "Invalid before_time/before_id cursor"}), 400
+            query = query.filter(tuple_(CheckIn.check_in_time, CheckIn.id) < cursor)
+
+        # Order by most recent first (id breaks ties between equal times)
+        query = query.order_by(CheckIn.check_in_time.desc(), CheckIn.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        checkins = query.all()
+        
+        # Prices by session type name, built once per request from the service
+        # cache - the same few names repeat on every row
+        prices = {s["name"]: s["price"] for s in get_services()}
+
         # Format response
         result = []
-        for checkin in checkins:
-            customer = Customer.query.get(checkin.customer_id)
-            
-            # Find the session type to get the price
-            session_type = SessionType.query.filter_by(name=checkin.session_type).first()
-            price = session_type.price if session_type else 0.0
-            
+        for row in checkins:
             result.append({
-                "id": checkin.id,
-                "customer_id": checkin.customer_id,
-                "customer_name": f"{customer.firstName} {customer.lastName}" if customer else "Unknown",
-                "customer_email": customer.email if customer else None,
-                "session_type": checkin.session_type,  # session_type is stored as string
-                "checkin_date": checkin.check_in_time.isoformat(),
-                "notes": checkin.notes,
-                "qb_invoice_id": checkin.qb_invoice_id,
-                "price": float(price)  # Add price for frontend display
+                "id": row.id,
+                "customer_id": row.customer_id,
+                "customer_name": f"{row.firstName} {row.lastName}" if row.firstName is not None else "Unknown",
+                "customer_email": row.email,
+                "session_type": row.session_type,  # session_type is stored as string
+                "checkin_date": row.check_in_time.isoformat(),
+                "notes": row.notes,
+                "qb_invoice_id": row.qb_invoice_id,
+                "price": float(prices.get(row.session_type) or 0.0)  # Add price for frontend display
             })
+
+        if limit is None:
+            return jsonify(result), 200
+
+        next_cursor = None
+        if len(checkins) == limit:
+            last = checkins[-1]
+            next_cursor = {"before_time": last.check_in_time.isoformat(), "before_id": last.id}
+        return jsonify({"checkins": result, "next_cursor": next_cursor}), 200
         
-        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@checkin_bp.route("/<int:checkin_id>/invoice", methods=["GET"])
+def get_checkin_invoice(checkin_id):
+    """
+    Get the QuickBooks invoice status of a check-in
+    
+    Invoices are created in the background after the check-in is confirmed,
+    so clients poll this until quickbooks_invoice_id is set.
+    """
+    try:
+        row = db.session.query(CheckIn.id, CheckIn.qb_invoice_id).filter(CheckIn.id == checkin_id).first()
+        if not row:
+            return jsonify({"error": "Check-in not found"}), 404
+        
+        return jsonify({
+            "checkin_id": row.id,
+            "quickbooks_invoice_id": row.qb_invoice_id,
+            "quickbooks": "processed" if row.qb_invoice_id else "pending"
+        }), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -562,56 +608,70 @@ def create_checkin():
     # Handles both direct UUID and URL formats
     extracted_qr_code = extract_qr_code_from_value(qrCodeValue)
     
-    print(f"[CHECK-IN] Original QR value: {qrCodeValue}")
-    print(f"[CHECK-IN] Extracted QR code: {extracted_qr_code}")
+    log.debug("[CHECK-IN] QR value %s → %s", qrCodeValue, extracted_qr_code)
 
-    # Look up customer using the extracted QR code
-    customer = Customer.query.filter_by(qr_code_data=extracted_qr_code).first()
+    # Look up customer using the extracted QR code - only the columns the
+    # check-in needs, LIMIT 1 on the indexed qr_code_data column
+    customer = db.session.query(
+        Customer.id, Customer.firstName, Customer.lastName
+    ).filter(Customer.qr_code_data == extracted_qr_code).first()
     
     if not customer:
-        print(f"[CHECK-IN] ✗ Customer not found with QR code: {extracted_qr_code}")
-        print(f"[CHECK-IN] ✗ Original value was: {qrCodeValue}")
+        log.info("[CHECK-IN] ✗ Customer not found with QR code: %s (original value: %s)", extracted_qr_code, qrCodeValue)
         return jsonify({
             "error": "Customer not found with this QR code",
             "qr_value_received": qrCodeValue,
             "qr_value_searched": extracted_qr_code
         }), 404
 
-    print(f"[CHECK-IN] ✓ Customer found: {customer.firstName} {customer.lastName} (ID: {customer.id})")
+    log.debug("[CHECK-IN] ✓ Customer found: %s %s (ID: %s)", customer.firstName, customer.lastName, customer.id)
     
-    session_type = SessionType.query.get(sessionTypeId)
+    # Session types are served from the in-process cache - no query per check-in
+    session_type = get_service(sessionTypeId)
     if not session_type:
         return jsonify({"error": "Session type not found"}), 404
 
-    # Create check-in
-    checkin = CheckIn(
-        customer_id=customer.id,
-        session_type=session_type.name,  # Store session type name, not ID
-        check_in_time=datetime.now(),
-        notes=notes
-    )
+    # Create check-in with a single INSERT ... RETURNING id; the response is
+    # built from values already in memory, so nothing is read back
+    check_in_time = datetime.now()
+    checkin_id = db.session.execute(
+        insert(CheckIn).values(
+            customer_id=customer.id,
+            session_type=session_type["name"],  # Store session type name, not ID
+            check_in_time=check_in_time,
+            notes=notes
+        ).returning(CheckIn.id)
+    ).scalar_one()
     
-    db.session.add(checkin)
-    db.session.commit()
+    customer_id = customer.id
+    customer_name = f"{customer.firstName} {customer.lastName}"
+    session_type_id = session_type["id"]
+    session_type_name = session_type["name"]
     
-    print(f"[CHECK-IN] Check-in successful for {customer.firstName} {customer.lastName} on {checkin.check_in_time.strftime('%Y-%m-%d')}")
+    db.session.commit()
     
-    # Create or update QuickBooks invoice
-    invoice_id = create_or_update_monthly_invoice(customer, session_type, checkin.id, checkin.check_in_time)
+    log.info("[CHECK-IN] Check-in successful for %s on %s", customer_name, check_in_time.date())
     
-    if invoice_id:
-        print(f"[CHECK-IN] ✓ QuickBooks invoice processed: {invoice_id}")
-    else:
-        print(f"[CHECK-IN] ⚠ QuickBooks invoice not created (may not be connected)")
+    # Create or update the QuickBooks invoice in the background so the
+    # check-in is confirmed without waiting on the QuickBooks round trips
+    _qb_background.submit(
+        process_checkin_invoice,
+        current_app._get_current_object(),
+        checkin_id,
+        customer_id,
+        session_type_id
+    )
 
     return jsonify({
         "message": "Check-in successful",
         "checkin": {
-            "id": checkin.id,
-            "customer_name": f"{customer.firstName} {customer.lastName}",
-            "session_type": session_type.name,
-            "checkin_date": checkin.check_in_time.isoformat(),
-            "notes": checkin.notes,
-            "quickbooks_invoice_id": invoice_id
+            "id": checkin_id,
+            "customer_name": customer_name,
+            "session_type": session_type_name,
+            "session_type_id": session_type_id,
+            "checkin_date": check_in_time.isoformat(),
+            "notes": notes,
+            "quickbooks_invoice_id": None,
+            "quickbooks": "queued"
         }
     }), 201
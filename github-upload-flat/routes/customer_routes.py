@@ -5,6 +5,12 @@ import uuid
 
 customer_bp = Blueprint('customers', __name__)
 
+# Columns returned by Customer.to_dict(), in the same order
+CUSTOMER_COLUMNS = ('id', 'firstName', 'lastName', 'phone', 'email', 'address', 'customer_type', 'qr_code_data', 'created_at')
+
+# Largest page get_all_customers will return when ?limit is given
+MAX_PAGE_SIZE = 500
+
 @customer_bp.route('/register', methods=['POST'])
 def register_customer():
     """Register a new customer"""
@@ -65,10 +71,47 @@ def get_customer_by_qr_data():
 
 @customer_bp.route('/', methods=['GET'])
 def get_all_customers():
-    """Get all customers"""
+    """
+    Get all customers
+
+    Without ?limit the full list is returned, as before. With ?limit=N the
+    response is one page ordered by ID: {"customers": [...], "next_cursor": id},
+    and the next page is fetched with ?limit=N&after_id=<next_cursor>
+    (null on the last page).
+    """
     try:
-        customers = Customer.query.all()
-        return jsonify([c.to_dict() for c in customers]), 200
+        limit = request.args.get('limit')
+        after_id = request.args.get('after_id')
+        if limit is not None:
+            try:
+                limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+            except ValueError:
+                return jsonify({"error": "limit must be an integer"}), 400
+
+        # Plain column tuples zipped into dicts - no Customer objects to
+        # build and track for what can be thousands of rows
+        query = db.session.query(*[getattr(Customer, c) for c in CUSTOMER_COLUMNS])
+        if limit is not None:
+            # Keyset pagination on the primary key
+            if after_id:
+                try:
+                    query = query.filter(Customer.id > int(after_id))
+                except ValueError:
+                    return jsonify({"error": "after_id must be an integer"}), 400
+            query = query.order_by(Customer.id).limit(limit)
+        rows = query.all()
+        result = []
+        for row in rows:
+            customer = dict(zip(CUSTOMER_COLUMNS, row))
+            created_at = customer['created_at']
+            customer['created_at'] = created_at.isoformat() if created_at else None
+            result.append(customer)
+
+        if limit is None:
+            return jsonify(result), 200
+
+        next_cursor = result[-1]['id'] if len(result) == limit else None
+        return jsonify({"customers": result, "next_cursor": next_cursor}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1,12 +1,58 @@
 from flask import Blueprint, request, jsonify
-import qrcode
-import io
-import base64
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
 import os
+import logging
+from utils.email_address import is_valid_email
+from utils.qr_image import generate_qr_code_png
+
+try:
+    import pybase64 as base64  # SIMD base64, same API as the stdlib module
+except ImportError:
+    import base64  # pybase64 not available, using the stdlib encoder
 
 email_bp = Blueprint('email', __name__, url_prefix='/api/email')
+log = logging.getLogger(__name__)
+
+# Settings read once at import
+BASE_URL = os.environ.get('BASE_URL', 'https://final-qr-code-version-that-works-production.up.railway.app')
+SENDGRID_FROM_EMAIL = os.environ.get('SENDGRID_FROM_EMAIL', 'noreply@yourdomain.com')
+
+# One client for every email instead of one per request
+_sendgrid = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+
+# Email body, filled with str.format(name=..., qr_url=...)
+_HTML_TEMPLATE = """
+<html>
+<body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background-color: #f8f9fa; padding: 30px; border-radius: 10px;">
+        <h1 style="color: #333; text-align: center;">Bienvenue {name}!</h1>
+        <p style="color: #666; font-size: 16px; line-height: 1.6;">
+            Merci de vous être enregistré(e). Voici votre QR code personnel pour le check-in.
+        </p>
+        <div style="text-align: center; margin: 30px 0;">
+            <img src="cid:qrcode" alt="QR Code" style="max-width: 300px; border: 2px solid #ddd; padding: 10px; background: white; border-radius: 10px;">
+        </div>
+        <div style="background-color: #e3f2fd; padding: 20px; border-radius: 5px; margin: 20px 0;">
+            <h3 style="color: #1976d2; margin-top: 0;">Comment utiliser votre QR code:</h3>
+            <ol style="color: #666; line-height: 1.8;">
+                <li>Scannez ce QR code avec votre téléphone lors de votre arrivée</li>
+                <li>Ou cliquez sur le lien ci-dessous depuis votre téléphone</li>
+                <li>Votre check-in sera enregistré automatiquement</li>
+            </ol>
+        </div>
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="{qr_url}" style="display: inline-block; background-color: #4CAF50; color: white; padding: 15px 30px; text-decoration: none; border-radius: 5px; font-weight: bold;">
+                Check-in Direct
+            </a>
+        </div>
+        <p style="color: #999; font-size: 12px; text-align: center; margin-top: 30px;">
+            Gardez cet email pour vos prochaines visites.
+        </p>
+    </div>
+</body>
+</html>
+"""
 
 @email_bp.route('/send-qr', methods=['POST'])
 def send_qr_email():
@@ -22,73 +68,28 @@ def send_qr_email():
         name = data['name']
         qr_code_data = data['qrCodeData']
         
-        print(f"[EMAIL] Request received - To: {email}, Name: {name}, QR Data: {qr_code_data}")
+        if not is_valid_email(email):
+            return jsonify({"error": "Invalid email address"}), 400
         
-        # Get the base URL from environment or use default
-        base_url = os.environ.get('BASE_URL', 'https://final-qr-code-version-that-works-production.up.railway.app')
+        log.debug("[EMAIL] Request received - To: %s, Name: %s, QR Data: %s", email, name, qr_code_data)
         
         # Create full URL for QR code
-        qr_url = f"{base_url}/checkin?qr={qr_code_data}"
+        qr_url = f"{BASE_URL}/checkin?qr={qr_code_data}"
         
-        print(f"[EMAIL] QR URL: {qr_url}")
+        log.debug("[EMAIL] QR URL: %s", qr_url)
         
         # Generate QR code with full URL
-        print(f"[EMAIL] Generating QR code for: {qr_url}")
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-        qr_base64 = base64.b64encode(buffer.getvalue()).decode()
+        qr_png = generate_qr_code_png(qr_url, error="l")
+        qr_base64 = base64.b64encode(qr_png).decode('ascii')
         
-        print(f"[EMAIL] QR code generated, base64 length: {len(qr_base64)}")
+        log.debug("[EMAIL] QR code generated, base64 length: %d", len(qr_base64))
         
         # Create email content
-        html_content = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-            <div style="background-color: #f8f9fa; padding: 30px; border-radius: 10px;">
-                <h1 style="color: #333; text-align: center;">Bienvenue {name}!</h1>
-                <p style="color: #666; font-size: 16px; line-height: 1.6;">
-                    Merci de vous être enregistré(e). Voici votre QR code personnel pour le check-in.
-                </p>
-                <div style="text-align: center; margin: 30px 0;">
-                    <img src="cid:qrcode" alt="QR Code" style="max-width: 300px; border: 2px solid #ddd; padding: 10px; background: white; border-radius: 10px;">
-                </div>
-                <div style="background-color: #e3f2fd; padding: 20px; border-radius: 5px; margin: 20px 0;">
-                    <h3 style="color: #1976d2; margin-top: 0;">Comment utiliser votre QR code:</h3>
-                    <ol style="color: #666; line-height: 1.8;">
-                        <li>Scannez ce QR code avec votre téléphone lors de votre arrivée</li>
-                        <li>Ou cliquez sur le lien ci-dessous depuis votre téléphone</li>
-                        <li>Votre check-in sera enregistré automatiquement</li>
-                    </ol>
-                </div>
-                <div style="text-align: center; margin: 30px 0;">
-                    <a href="{qr_url}" style="display: inline-block; background-color: #4CAF50; color: white; padding: 15px 30px; text-decoration: none; border-radius: 5px; font-weight: bold;">
-                        Check-in Direct
-                    </a>
-                </div>
-                <p style="color: #999; font-size: 12px; text-align: center; margin-top: 30px;">
-                    Gardez cet email pour vos prochaines visites.
-                </p>
-            </div>
-        </body>
-        </html>
-        """
+        html_content = _HTML_TEMPLATE.format(name=name, qr_url=qr_url)
         
         # Create SendGrid message
         message = Mail(
-            from_email=os.environ.get('SENDGRID_FROM_EMAIL', 'noreply@yourdomain.com'),
+            from_email=SENDGRID_FROM_EMAIL,
             to_emails=email,
             subject=f'Votre QR Code - {name}',
             html_content=html_content
@@ -105,11 +106,10 @@ def send_qr_email():
         message.attachment = attachment
         
         # Send email
-        print(f"[EMAIL] Sending email to {email}...")
-        sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
+        log.debug("[EMAIL] Sending email to %s...", email)
+        response = _sendgrid.send(message)
         
-        print(f"[EMAIL] SendGrid response: {response.status_code}")
+        log.info("[EMAIL] SendGrid response for %s: %s", email, response.status_code)
         
         if response.status_code in [200, 201, 202]:
             return jsonify({
@@ -120,5 +120,5 @@ def send_qr_email():
             return jsonify({"error": "Failed to send email"}), 500
             
     except Exception as e:
-        print(f"[EMAIL] Error: {str(e)}")
+        log.warning("[EMAIL] Error: %s", e)
         return jsonify({"error": str(e)}), 500
@@ -1,54 +1,36 @@
 from flask import Blueprint, request, jsonify
 import os
+import logging
 import requests
-import qrcode
-import io
-import base64
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.email_address import is_valid_email
+from utils.qr_image import generate_qr_code_png
 
 email_improved_bp = Blueprint("email_improved_bp", __name__)
+log = logging.getLogger(__name__)
 
-def generate_qr_code_base64(data_string):
-    """Generate QR code and return as base64 string"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(data_string)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert to base64
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.read()).decode('utf-8')
-    
-    return img_base64
+# Worker that generates the QR code and talks to Mailgun after the response
+# has been sent, so a slow send never holds a request thread
+_email_background = ThreadPoolExecutor(max_workers=4, thread_name_prefix="email")
 
-def send_email_with_generated_qr(to_email, customer_name, qr_code_data):
-    """
-    Generate QR code on backend and send as attachment via Mailgun
-    Returns (success: bool, message: str)
-    """
-    mailgun_api_key = os.environ.get("MAILGUN_API_KEY")
-    mailgun_domain = os.environ.get("MAILGUN_DOMAIN")
-    from_email = os.environ.get("FROM_EMAIL", "Doulos Education <noreply@doulos.education>")
-    
-    if not mailgun_api_key:
-        return False, "Mailgun API key not configured"
-    
-    if not mailgun_domain:
-        return False, "Mailgun domain not configured"
-    
-    try:
-        # ✅ FIX: Generate QR code with customer's unique ID instead of homepage URL
-        # This allows the scanner to look up the customer in the database
-        print(f"[EMAIL] Generating QR code with customer ID: {qr_code_data}")
-        qr_base64 = generate_qr_code_base64(qr_code_data)
-        print(f"[EMAIL] QR code generated, base64 length: {len(qr_base64)}")
-        
-        # Mailgun API endpoint
-        url = f"https://api.mailgun.net/v3/{mailgun_domain}/messages"
-        
-        # Plain text content in French (without check-in link)
-        text_content = f"""Cher(ère) {customer_name},
+# Mailgun settings, read once at import (main.py loads .env before importing routes)
+MAILGUN_API_KEY = os.environ.get("MAILGUN_API_KEY")
+MAILGUN_DOMAIN = os.environ.get("MAILGUN_DOMAIN")
+FROM_EMAIL = os.environ.get("FROM_EMAIL", "Doulos Education <noreply@doulos.education>")
+MAILGUN_URL = f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages"
+
+# Kept-alive connections to Mailgun, shared by the email workers. Retry only
+# covers failed connects - a POST that reached Mailgun is never re-sent.
+_mailgun_session = requests.Session()
+_mailgun_session.mount("https://", HTTPAdapter(
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+# Plain text content in French (without check-in link)
+_TEXT_TEMPLATE_FR = """Cher(ère) {customer_name},
 
 Merci de vous être inscrit(e) au Programme de Tutorat Doulos Éducation !
 
@@ -70,45 +52,69 @@ L'équipe Doulos Éducation
 ---
 Ceci est un message automatisé. Veuillez ne pas répondre à ce courriel.
 """
+
+def send_email_with_generated_qr(to_email, customer_name, qr_code_data):
+    """
+    Generate QR code on backend and send as attachment via Mailgun
+    Returns (success: bool, message: str)
+    """
+    if not MAILGUN_API_KEY:
+        return False, "Mailgun API key not configured"
+    
+    if not MAILGUN_DOMAIN:
+        return False, "Mailgun domain not configured"
+    
+    try:
+        # ✅ FIX: Generate QR code with customer's unique ID instead of homepage URL
+        # This allows the scanner to look up the customer in the database
+        log.debug("[EMAIL] Generating QR code with customer ID: %s", qr_code_data)
+        qr_image_binary = generate_qr_code_png(qr_code_data)
+        log.debug("[EMAIL] QR code generated, PNG size: %d bytes", len(qr_image_binary))
         
-        # Decode base64 to binary for Mailgun
-        qr_image_binary = base64.b64decode(qr_base64)
+        text_content = _TEXT_TEMPLATE_FR.format(customer_name=customer_name)
         
-        # Prepare multipart form data for Mailgun
+        # Prepare multipart form data for Mailgun (raw PNG bytes, no base64)
         files = {
             'attachment': (f"{customer_name.replace(' ', '_')}_CodeQR.png", qr_image_binary, 'image/png')
         }
         
         data = {
-            'from': from_email,
+            'from': FROM_EMAIL,
             'to': to_email,
             'subject': 'Votre code QR pour Doulos Éducation',
             'text': text_content
         }
         
-        print(f"[EMAIL] Sending email to {to_email} via Mailgun...")
-        response = requests.post(
-            url,
-            auth=('api', mailgun_api_key),
+        log.debug("[EMAIL] Sending email to %s via Mailgun...", to_email)
+        response = _mailgun_session.post(
+            MAILGUN_URL,
+            auth=('api', MAILGUN_API_KEY),
             files=files,
             data=data,
             timeout=10
         )
-        print(f"[EMAIL] Mailgun response: {response.status_code}")
+        log.debug("[EMAIL] Mailgun response: %s", response.status_code)
         
         if response.status_code == 200:
-            print(f"[EMAIL] Email sent successfully via Mailgun")
+            log.info("[EMAIL] Email sent successfully via Mailgun to %s", to_email)
             return True, f"Email sent successfully via Mailgun (status: {response.status_code})"
         else:
             error_msg = f"Mailgun returned status code: {response.status_code} - {response.text}"
-            print(f"[EMAIL] ERROR: {error_msg}")
+            log.warning("[EMAIL] ERROR: %s", error_msg)
             return False, error_msg
             
     except Exception as e:
         error_msg = f"Error sending email: {str(e)}"
-        print(f"[EMAIL] EXCEPTION: {error_msg}")
+        log.warning("[EMAIL] EXCEPTION: %s", error_msg)
         return False, error_msg
 
+def send_email_in_background(to_email, customer_name, qr_code_data):
+    """Run send_email_with_generated_qr on the email worker (it logs its own result)"""
+    try:
+        send_email_with_generated_qr(to_email, customer_name, qr_code_data)
+    except Exception:
+        log.exception("[EMAIL] EXCEPTION: Background send to %s failed", to_email)
+
 def handle_qr_email_request():
     """Common handler for all QR email routes"""
     data = request.get_json()
@@ -118,51 +124,35 @@ def handle_qr_email_request():
     customer_name = data.get("customer_name") or data.get("name")
     qr_code_data = data.get("qr_code_data") or data.get("qrCodeData") or data.get("qr_data")
 
-    print(f"[EMAIL] Request received - To: {recipient_email}, Name: {customer_name}, QR Data: {qr_code_data}")
+    log.debug("[EMAIL] Request received - To: %s, Name: %s, QR Data: %s", recipient_email, customer_name, qr_code_data)
 
     if not all([recipient_email, customer_name, qr_code_data]):
         return jsonify({"error": "Missing required email data"}), 400
 
+    if not is_valid_email(recipient_email):
+        return jsonify({"error": "Invalid email address"}), 400
+
     # Check if Mailgun is configured
-    mailgun_api_key = os.environ.get("MAILGUN_API_KEY")
-    
-    if not mailgun_api_key:
+    if not MAILGUN_API_KEY:
         return jsonify({"message": "Mailgun not configured", "simulated": True}), 200
     
-    # Generate QR code and send email
-    success, message = send_email_with_generated_qr(
+    # Checked here rather than only in the background job, so a
+    # misconfiguration is still reported to the client
+    if not MAILGUN_DOMAIN:
+        return jsonify({"error": "Mailgun domain not configured", "simulated": False}), 500
+    
+    # Generate QR code and send email in the background - the result is
+    # logged, the client only learns that the email was accepted
+    _email_background.submit(
+        send_email_in_background,
         recipient_email,
         customer_name,
         qr_code_data
     )
     
-    if success:
-        return jsonify({"message": message, "simulated": False}), 200
-    else:
-        return jsonify({"error": message, "simulated": False}), 500
+    return jsonify({"message": "Email queued for sending via Mailgun", "queued": True, "simulated": False}), 202
 
 # CREATE ALL POSSIBLE ROUTES - so any frontend call will work!
-@email_improved_bp.route("/send-qr", methods=["POST"])
-def send_qr_code_email_1():
-    """Send QR code email - Route 1"""
-    return handle_qr_email_request()
-
-@email_improved_bp.route("/send-qr-email", methods=["POST"])
-def send_qr_code_email_2():
-    """Send QR code email - Route 2"""
-    return handle_qr_email_request()
-
-@email_improved_bp.route("/send-qr-code", methods=["POST"])
-def send_qr_code_email_3():
-    """Send QR code email - Route 3"""
-    return handle_qr_email_request()
-
-@email_improved_bp.route("/send-qr-code-v2", methods=["POST"])
-def send_qr_code_email_4():
-    """Send QR code email - Route 4"""
-    return handle_qr_email_request()
-
-@email_improved_bp.route("/send", methods=["POST"])
-def send_qr_code_email_5():
-    """Send QR code email - Route 5"""
-    return handle_qr_email_request()
+# One view registered under every path the frontends have used
+for _path in ("/send-qr", "/send-qr-email", "/send-qr-code", "/send-qr-code-v2", "/send"):
+    email_improved_bp.add_url_rule(_path, view_func=handle_qr_email_request, methods=["POST"])
@@ -3,20 +3,24 @@ import os
 
 pages_bp = Blueprint("pages_bp", __name__)
 
+# Resolved once instead of on every page load
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
+
+# Browsers may reuse a page for 5 minutes, then revalidate it with
+# If-None-Match / If-Modified-Since and get a 304 if it hasn't changed
+PAGE_MAX_AGE = 300
+
 @pages_bp.route("/register-customer", methods=["GET"])
 def register_customer_page():
     """Serve the customer registration HTML page"""
-    static_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
-    return send_from_directory(static_folder, 'register_customer.html')
+    return send_from_directory(STATIC_FOLDER, 'register_customer.html', max_age=PAGE_MAX_AGE, conditional=True)
 
 @pages_bp.route("/history", methods=["GET"])
 def history_page():
     """Serve the check-in history HTML page"""
-    static_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
-    return send_from_directory(static_folder, 'history.html')
+    return send_from_directory(STATIC_FOLDER, 'history.html', max_age=PAGE_MAX_AGE, conditional=True)
 
 @pages_bp.route("/quickbooks", methods=["GET"])
 def quickbooks_page():
     """Serve the QuickBooks sync HTML page"""
-    static_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
-    return send_from_directory(static_folder, 'quickbooks.html')
+    return send_from_directory(STATIC_FOLDER, 'quickbooks.html', max_age=PAGE_MAX_AGE, conditional=True)
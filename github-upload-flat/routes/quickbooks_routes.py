@@ -14,6 +14,8 @@ from flask import Blueprint, request, jsonify, redirect
 import requests
 import os
 import json
+import functools
+import logging
 from datetime import datetime, timedelta
 from db import db
 from models.models import QuickBooksToken
@@ -23,10 +25,13 @@ from utils.token_storage import (
     delete_token_file, 
     is_token_valid,
     get_valid_token,  # NOUVEAU: Fonction qui rafraîchit automatiquement
+    get_cached_token,
     refresh_access_token  # NOUVEAU: Pour rafraîchissement manuel si nécessaire
 )
+from utils.qb_http import qb_session, qb_json, qb_headers
 
 quickbooks_bp = Blueprint("quickbooks_bp", __name__)
+log = logging.getLogger(__name__)
 
 # QuickBooks OAuth Configuration
 QB_CLIENT_ID = os.environ.get("QB_CLIENT_ID", "AB32rXJy5ipKKQaRgwX0ci4v770Ja9B3hvHTRERj25XTsQr5g8")
@@ -44,6 +49,13 @@ else:
     QB_TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
     QB_API_URL = "https://sandbox-quickbooks.api.intuit.com"
 
+# Endpoint templates for make_qb_api_call ({realmId} is filled in per call)
+INVOICE_ENDPOINT = "/v3/company/{realmId}/invoice"
+LAST_DOC_NUMBER_ENDPOINT = "/v3/company/{realmId}/query?query=SELECT DocNumber FROM Invoice ORDERBY DocNumber DESC MAXRESULTS 1"
+
+# HTTP methods make_qb_api_call accepts
+QB_API_METHODS = frozenset(["GET", "POST", "PUT"])
+
 def get_qb_token():
     """Get the latest QuickBooks token from database (legacy function)"""
     return QuickBooksToken.query.order_by(QuickBooksToken.updated_at.desc()).first()
@@ -51,23 +63,36 @@ def get_qb_token():
 def save_qb_token(access_token, refresh_token, realm_id, expires_in):
     """Save QuickBooks token to file (persistent across requests)"""
     try:
-        print(f"Saving token for realm {realm_id}")
+        log.debug("Saving token for realm %s", realm_id)
         success = save_token_to_file(access_token, refresh_token, realm_id, expires_in)
         if success:
-            print(f"✓ Token saved successfully for realm {realm_id}")
+            log.info("✓ Token saved successfully for realm %s", realm_id)
             # Verify it was saved
             verify_token = load_token_from_file()
             if verify_token:
-                print(f"✓ Verification: Token exists in file with realm {verify_token.get('realm_id')}")
+                log.debug("✓ Verification: Token exists in file with realm %s", verify_token.get('realm_id'))
             else:
-                print("✗ WARNING: Token not found after save!")
+                log.warning("✗ Token not found after save!")
             return verify_token
         else:
             raise Exception("Failed to save token to file")
     except Exception as e:
-        print(f"✗ ERROR saving token: {str(e)}")
+        log.error("✗ ERROR saving token: %s", e)
         raise
 
+@functools.lru_cache(maxsize=64)
+def _url_template(endpoint):
+    """
+    Full URL for an endpoint, pre-split around {realmId}
+
+    Args:
+        endpoint (str): API endpoint, with or without a {realmId} placeholder
+
+    Returns:
+        tuple: URL pieces to join with the realm ID
+    """
+    return tuple(f"{QB_API_URL}{endpoint}".split("{realmId}"))
+
 def make_qb_api_call(endpoint, method="GET", data=None, token_data=None):
     """
     Make a QuickBooks API call with automatic token refresh on 401 errors
@@ -81,62 +106,50 @@ def make_qb_api_call(endpoint, method="GET", data=None, token_data=None):
     Returns:
         tuple: (response_data, status_code) or (None, error_code)
     """
-    # Get valid token (will refresh if needed)
+    # Get valid token - refreshed ahead of expiry, so an expired token
+    # doesn't cost a failed call first
     if not token_data:
-        token_data = get_valid_token()
+        token_data = get_cached_token()
     
     if not token_data:
         return {"error": "Not connected to QuickBooks"}, 401
     
-    # Build full URL
-    url = f"{QB_API_URL}{endpoint}"
-    if "{realmId}" in url:
-        url = url.replace("{realmId}", token_data.get('realm_id'))
+    method = method.upper()
+    if method not in QB_API_METHODS:
+        return {"error": f"Unsupported HTTP method: {method}"}, 400
     
-    headers = {
-        "Authorization": f"Bearer {token_data.get('access_token')}",
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
+    # Build full URL (the template is built once per endpoint)
+    url = token_data.get('realm_id').join(_url_template(endpoint))
+    
+    # Shared per-token dict (Accept is already a qb_session default)
+    headers = qb_headers(token_data.get('access_token'))
     
     try:
-        # Make API call
-        if method.upper() == "GET":
-            response = requests.get(url, headers=headers, timeout=10)
-        elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=data, timeout=10)
-        elif method.upper() == "PUT":
-            response = requests.put(url, headers=headers, json=data, timeout=10)
-        else:
-            return {"error": f"Unsupported HTTP method: {method}"}, 400
+        # Make API call (no body is sent when data is None, e.g. for GET)
+        response = qb_session.request(method, url, headers=headers, json=data, timeout=10)
         
-        # Handle 401 Unauthorized - token might be expired
+        # Handle 401 Unauthorized - the token was checked above, so this is
+        # a fallback for tokens revoked on Intuit's side
         if response.status_code == 401:
-            print("⚠ Received 401 Unauthorized. Attempting token refresh...")
+            log.warning("⚠ Received 401 Unauthorized. Attempting token refresh...")
             
             # Try to refresh token
             new_token_data = refresh_access_token()
             if new_token_data:
-                print("✓ Token refreshed. Retrying API call...")
+                log.info("✓ Token refreshed. Retrying API call...")
                 # Retry the call with new token
-                headers["Authorization"] = f"Bearer {new_token_data.get('access_token')}"
-                
-                if method.upper() == "GET":
-                    response = requests.get(url, headers=headers, timeout=10)
-                elif method.upper() == "POST":
-                    response = requests.post(url, headers=headers, json=data, timeout=10)
-                elif method.upper() == "PUT":
-                    response = requests.put(url, headers=headers, json=data, timeout=10)
+                headers = qb_headers(new_token_data.get('access_token'))
+                response = qb_session.request(method, url, headers=headers, json=data, timeout=10)
                 
                 if response.status_code in [200, 201]:
-                    print("✓ Retry successful after token refresh")
+                    log.info("✓ Retry successful after token refresh")
             else:
-                print("✗ Token refresh failed. User must reconnect.")
+                log.error("✗ Token refresh failed. User must reconnect.")
                 return {"error": "Token expired and refresh failed. Please reconnect to QuickBooks."}, 401
         
         # Return response
         if response.status_code in [200, 201]:
-            return response.json(), response.status_code
+            return qb_json(response), response.status_code
         else:
             return {"error": response.text}, response.status_code
             
@@ -159,11 +172,8 @@ def get_next_invoice_number(token_data):
     """
     try:
         # Query for the most recent invoice
-        query = "SELECT * FROM Invoice ORDERBY DocNumber DESC MAXRESULTS 1"
-        endpoint = f"/v3/company/{token_data.get('realm_id')}/query?query={query}"
-        
         response_data, status_code = make_qb_api_call(
-            endpoint=endpoint,
+            endpoint=LAST_DOC_NUMBER_ENDPOINT,
             method="GET",
             token_data=token_data
         )
@@ -173,7 +183,7 @@ def get_next_invoice_number(token_data):
             
             if invoices and len(invoices) > 0:
                 last_doc_number = invoices[0].get('DocNumber')
-                print(f"[INVOICE_NUMBER] Last invoice number: {last_doc_number}")
+                log.debug("[INVOICE_NUMBER] Last invoice number: %s", last_doc_number)
                 
                 # Try to extract numeric part and increment
                 if last_doc_number:
@@ -207,15 +217,15 @@ def get_next_invoice_number(token_data):
         date_prefix = now.strftime("%Y%m%d")
         time_suffix = now.strftime("%H%M%S")
         invoice_number = f"{date_prefix}-{time_suffix}"
-        print(f"[INVOICE_NUMBER] Generated fallback number: {invoice_number}")
+        log.info("[INVOICE_NUMBER] Generated fallback number: %s", invoice_number)
         return invoice_number
         
     except Exception as e:
-        print(f"[INVOICE_NUMBER] Error getting next invoice number: {str(e)}")
+        log.warning("[INVOICE_NUMBER] Error getting next invoice number: %s", e)
         # Fallback: Generate based on timestamp
         now = datetime.now()
         invoice_number = now.strftime("%Y%m%d-%H%M%S")
-        print(f"[INVOICE_NUMBER] Using timestamp fallback: {invoice_number}")
+        log.info("[INVOICE_NUMBER] Using timestamp fallback: %s", invoice_number)
         return invoice_number
 
 @quickbooks_bp.route("/connect", methods=["GET"])
@@ -285,7 +295,7 @@ def quickbooks_callback():
         
         if token_response.status_code == 200:
             tokens = token_response.json()
-            print(f"✓ Received tokens from QuickBooks for realm {realm_id}")
+            log.info("✓ Received tokens from QuickBooks for realm %s", realm_id)
             # Save tokens to file
             try:
                 saved_token = save_qb_token(
@@ -294,9 +304,9 @@ def quickbooks_callback():
                     realm_id=realm_id,
                     expires_in=tokens.get("expires_in", 3600)
                 )
-                print(f"✓ Token saved successfully for realm: {realm_id}")
+                log.info("✓ Token saved successfully for realm: %s", realm_id)
             except Exception as save_error:
-                print(f"✗ CRITICAL ERROR saving token: {str(save_error)}")
+                log.critical("✗ CRITICAL ERROR saving token: %s", save_error)
                 return f"<html><body><h1>Error saving token</h1><p>{str(save_error)}</p></body></html>", 500
             
             return """
@@ -394,7 +404,7 @@ def create_invoice():
     
     # ✅ NOUVEAU: Générer le numéro de facture automatiquement
     invoice_number = get_next_invoice_number(token_data)
-    print(f"[QUICKBOOKS] Creating invoice with DocNumber: {invoice_number}")
+    log.debug("[QUICKBOOKS] Creating invoice with DocNumber: %s", invoice_number)
     
     # Create invoice data with DocNumber
     invoice_data = {
@@ -417,7 +427,7 @@ def create_invoice():
     
     # Use the new make_qb_api_call function which handles refresh automatically
     response_data, status_code = make_qb_api_call(
-        endpoint=f"/v3/company/{token_data.get('realm_id')}/invoice",
+        endpoint=INVOICE_ENDPOINT,
         method="POST",
         data=invoice_data,
         token_data=token_data
@@ -426,7 +436,7 @@ def create_invoice():
     if status_code in [200, 201]:
         created_invoice = response_data.get('Invoice', {})
         doc_number = created_invoice.get('DocNumber', invoice_number)
-        print(f"[QUICKBOOKS] ✓ Invoice created successfully with DocNumber: {doc_number}")
+        log.info("[QUICKBOOKS] ✓ Invoice created successfully with DocNumber: %s", doc_number)
         
         return jsonify({
             "message": f"Invoice created successfully with number: {doc_number}",
@@ -434,7 +444,7 @@ def create_invoice():
             "invoice": response_data
         }), 200
     else:
-        print(f"[QUICKBOOKS] ✗ Error creating invoice: {response_data}")
+        log.error("[QUICKBOOKS] ✗ Error creating invoice: %s", response_data)
         return jsonify(response_data), status_code
 
 @quickbooks_bp.route("/test-refresh", methods=["GET"])
@@ -443,9 +453,7 @@ def test_token_refresh():
     Test endpoint to manually trigger token refresh
     Useful for debugging and verification
     """
-    print("\n" + "="*60)
-    print("MANUAL TOKEN REFRESH TEST")
-    print("="*60 + "\n")
+    log.info("MANUAL TOKEN REFRESH TEST")
     
     # Load current token
     current_token = load_token_from_file()
@@ -456,9 +464,8 @@ def test_token_refresh():
         }), 404
     
     # Show current token info
-    print(f"Current token realm: {current_token.get('realm_id')}")
-    print(f"Expires at: {current_token.get('expires_at')}")
-    print(f"Is valid: {is_token_valid(current_token)}")
+    log.info("Current token realm: %s, expires at: %s, valid: %s",
+             current_token.get('realm_id'), current_token.get('expires_at'), is_token_valid(current_token))
     
     # Try to refresh
     new_token = refresh_access_token()
@@ -1,12 +1,22 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from db import db
 from models.models import Customer, CheckIn, SessionType
 from datetime import datetime
-import requests
+from sqlalchemy import select, update
+import calendar
 import os
-from utils.token_storage import load_token_from_file, is_token_valid
+import logging
+from utils.token_storage import get_cached_token
+from utils.qb_http import qb_session, qbo_escape, qb_headers, qb_json, resolve_qb_refs, qb_invalid_refs, QuickBooksInvalidRef
+from utils.qb_cache import forget_ref
+from utils.invoice_lock import lock_monthly_invoice
+from concurrent.futures import ThreadPoolExecutor
 
 session_bp = Blueprint('sessions', __name__)
+log = logging.getLogger(__name__)
+
+# Worker that creates invoices after the session response has been sent
+_qb_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qb-manual")
 
 @session_bp.route('/api/sessions/manual', methods=['POST'])
 def create_manual_session():
@@ -22,19 +32,26 @@ def create_manual_session():
         if not customer_id or not service_id or not session_date:
             return jsonify({'error': 'Missing required fields'}), 400
 
-        # Get customer
-        customer = Customer.query.get(customer_id)
-        if not customer:
+        # Get customer and service in one query; the outer join keeps the
+        # customer row when the service doesn't exist
+        row = db.session.execute(
+            select(Customer, SessionType)
+            .outerjoin(SessionType, SessionType.id == service_id)
+            .where(Customer.id == customer_id)
+        ).first()
+        if not row:
             return jsonify({'error': 'Customer not found'}), 404
 
-        # Get service
-        service = SessionType.query.get(service_id)
+        customer, service = row
         if not service:
             return jsonify({'error': 'Service not found'}), 404
 
-        # Parse session date
+        # Parse session date (fromisoformat has a C fast path; the shape check
+        # keeps rejecting the other ISO forms it accepts, e.g. "20260903")
         try:
-            session_datetime = datetime.strptime(session_date, '%Y-%m-%d')
+            if len(session_date) != 10 or session_date[4] != '-' or session_date[7] != '-':
+                raise ValueError(session_date)
+            session_datetime = datetime.fromisoformat(session_date)
         except ValueError:
             return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
 
@@ -50,109 +67,181 @@ def create_manual_session():
         db.session.add(check_in)
         db.session.commit()
 
-        print(f"[MANUAL SESSION] Created for {customer.firstName} {customer.lastName} - {service.name}")
+        log.info("[MANUAL SESSION] Created for %s %s - %s", customer.firstName, customer.lastName, service.name)
 
-        # Try to create QuickBooks invoice
-        qb_invoice_id = None
-        try:
-            qb_invoice_id = create_or_update_quickbooks_invoice(customer, service, session_datetime, check_in.id)
-            if qb_invoice_id:
-                check_in.qb_invoice_id = qb_invoice_id
-                db.session.commit()
-                print(f"[MANUAL SESSION] ✓ QuickBooks invoice created/updated: {qb_invoice_id}")
-        except Exception as qb_error:
-            print(f"[MANUAL SESSION] ⚠ QuickBooks invoice creation failed: {str(qb_error)}")
+        # Create the QuickBooks invoice in the background so the form doesn't
+        # wait on QuickBooks; the ID is saved on the check-in when it's done
+        _qb_background.submit(
+            process_manual_session_invoice,
+            current_app._get_current_object(),
+            check_in.id,
+            customer.id,
+            service.id
+        )
 
         return jsonify({
             'success': True,
             'check_in_id': check_in.id,
-            'qb_invoice_id': qb_invoice_id,
+            'qb_invoice_id': None,
+            'quickbooks': 'queued',
             'message': 'Session enregistrée avec succès'
         }), 201
 
     except Exception as e:
         db.session.rollback()
-        print(f"[MANUAL SESSION] Error: {str(e)}")
+        log.exception("[MANUAL SESSION] Error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
+def process_manual_session_invoice(app, check_in_id, customer_id, service_id):
+    """
+    Background job: create or update the QuickBooks invoice for a manual session
+
+    Args:
+        app (Flask): Application to push a context for
+        check_in_id (int): ID of the committed check-in
+        customer_id (int): ID of the customer
+        service_id (int): ID of the service (session type)
+    """
+    with app.app_context():
+        try:
+            # One query for the session date, customer and service
+            row = db.session.execute(
+                select(CheckIn.check_in_time, Customer, SessionType)
+                .select_from(CheckIn)
+                .join(Customer, Customer.id == customer_id)
+                .join(SessionType, SessionType.id == service_id)
+                .where(CheckIn.id == check_in_id)
+            ).first()
+            if not row:
+                log.warning("[MANUAL SESSION] ⚠ Check-in %s no longer exists - skipping invoice", check_in_id)
+                return
+            check_in_time, customer, service = row
+
+            # Held until the commit below (shared with QR check-ins)
+            lock_monthly_invoice(customer.id, check_in_time)
+
+            qb_invoice_id = create_or_update_quickbooks_invoice(customer, service, check_in_time, check_in_id)
+            if qb_invoice_id:
+                # Plain UPDATE - the check-in row was never loaded
+                db.session.execute(
+                    update(CheckIn).where(CheckIn.id == check_in_id).values(qb_invoice_id=qb_invoice_id)
+                )
+                log.info("[MANUAL SESSION] ✓ QuickBooks invoice created/updated: %s", qb_invoice_id)
+            # Also saves the QuickBooks IDs set (or cleared) on the customer/service
+            db.session.commit()
+        except Exception as qb_error:
+            db.session.rollback()
+            log.exception("[MANUAL SESSION] ⚠ QuickBooks invoice creation failed: %s", qb_error)
+
+
 def create_or_update_quickbooks_invoice(customer, service, session_date, check_in_id):
     """Create or update QuickBooks invoice for the session"""
     
-    # Load QuickBooks token
-    token_data = load_token_from_file()
-    if not token_data or not is_token_valid(token_data):
-        print("[QUICKBOOKS] Not connected to QuickBooks - skipping invoice creation")
+    # Load QuickBooks token (cached in memory, refreshed if expired)
+    token_data = get_cached_token()
+    if not token_data:
+        log.info("[QUICKBOOKS] Not connected to QuickBooks - skipping invoice creation")
         return None
 
     access_token = token_data.get('access_token')
     realm_id = token_data.get('realm_id')
 
-    # Get month/year for invoice grouping
-    invoice_month = session_date.strftime('%Y-%m')
+    log.debug("[QUICKBOOKS] Processing invoice for %s %s - %s", customer.firstName, customer.lastName, service.name)
+
+    # Find or create the customer and the service item in QuickBooks, unless
+    # their IDs are already saved on the rows
+    # (set on the rows and saved with the caller's commit; cleared again
+    # below if QuickBooks rejects one of them as deleted)
+    customer_ref, item_ref = resolve_qb_refs(customer, service, access_token, realm_id, "https://quickbooks.api.intuit.com")
+
+    if not customer_ref or not item_ref:
+        log.warning("[QUICKBOOKS] Failed to find/create customer or item")
+        return None
+
+    qb_customer_id, qb_item_id = customer_ref["value"], item_ref["value"]
+
+    # Get month/year for invoice grouping, and the session day as a QBO
+    # date string (built once for the line description or TxnDate)
+    year, month = session_date.year, session_date.month
+    session_day = f"{year:04d}-{month:02d}-{session_date.day:02d}"
     
     # Search for existing invoice for this customer in this month
-    existing_invoice = search_monthly_invoice(access_token, realm_id, customer, invoice_month)
+    existing_invoice = search_monthly_invoice(access_token, realm_id, qb_customer_id, year, month)
     
-    if existing_invoice:
-        # Add line to existing invoice
-        return add_line_to_invoice(access_token, realm_id, existing_invoice, service, session_date, check_in_id)
-    else:
-        # Create new invoice
-        return create_new_invoice(access_token, realm_id, customer, service, session_date, check_in_id)
+    try:
+        if existing_invoice:
+            # Add line to existing invoice
+            invoice_id = add_line_to_invoice(access_token, realm_id, existing_invoice, qb_item_id, service, session_day, check_in_id)
+        else:
+            # Create new invoice
+            invoice_id = create_new_invoice(access_token, realm_id, qb_customer_id, qb_item_id, service, session_day, check_in_id)
+    except QuickBooksInvalidRef as e:
+        # The saved/cached customer or item was deleted in QuickBooks. Other
+        # failures (stale SyncToken, 5xx, open circuit) keep the IDs
+        log.warning("[QUICKBOOKS] %s", e)
+        if "Customer" in e.entities:
+            customer.qb_customer_id = None
+            forget_ref((realm_id, "Customer", f"{customer.firstName} {customer.lastName}"))
+        if "Item" in e.entities:
+            service.qb_item_id = None
+            forget_ref((realm_id, "Item", service.name))
+        return None
+
+    if invoice_id:
+        # QR check-ins cache this month's invoice (see checkin_routes); it has
+        # just changed, so drop the copy instead of letting them post a stale
+        # SyncToken
+        forget_ref((realm_id, "Invoice", qb_customer_id, year, month))
+    return invoice_id
 
 
-def search_monthly_invoice(access_token, realm_id, customer, invoice_month):
+def search_monthly_invoice(access_token, realm_id, qb_customer_id, year, month):
     """Search for an existing invoice for this customer in this month"""
     try:
-        # First, find or create the customer in QuickBooks
-        qb_customer_id = find_or_create_qb_customer(access_token, realm_id, customer)
-        if not qb_customer_id:
-            return None
-
-        # Search for invoices for this customer
-        query = f"SELECT * FROM Invoice WHERE CustomerRef = '{qb_customer_id}' MAXRESULTS 100"
+        # Search for unpaid invoices for this customer in this month - QuickBooks
+        # does the filtering and only returns the fields add_line_to_invoice uses
+        invoice_month = f"{year:04d}-{month:02d}"
+        query = (
+            f"SELECT Id, SyncToken, Line FROM Invoice WHERE CustomerRef = '{qbo_escape(qb_customer_id)}' "
+            f"AND TxnDate >= '{invoice_month}-01' AND TxnDate <= '{invoice_month}-{calendar.monthrange(year, month)[1]:02d}' "
+            f"AND Balance > '0' MAXRESULTS 1"
+        )
         
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json"
-        }
+        headers = qb_headers(access_token)
         
         url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-        response = requests.get(url, headers=headers, params={"query": query})
+        response = qb_session.get(url, headers=headers, params={"query": query})
         
         if response.status_code == 200:
-            data = response.json()
+            data = qb_json(response)
             invoices = data.get("QueryResponse", {}).get("Invoice", [])
             
-            # Filter invoices by month and unpaid status
-            for invoice in invoices:
-                invoice_date = invoice.get("TxnDate", "")
-                if invoice_date.startswith(invoice_month):
-                    balance = float(invoice.get("Balance", 0))
-                    if balance > 0:  # Invoice not fully paid
-                        print(f"[QUICKBOOKS] ✓ Found existing invoice: ID {invoice['Id']} for {invoice_month}")
-                        return invoice
+            if invoices:
+                invoice = invoices[0]
+                log.debug("[QUICKBOOKS] ✓ Found existing invoice: ID %s for %s", invoice['Id'], invoice_month)
+                return invoice
         
-        print(f"[QUICKBOOKS] No existing invoice found for {invoice_month}")
+        log.debug("[QUICKBOOKS] No existing invoice found for %s", invoice_month)
         return None
         
     except Exception as e:
-        print(f"[QUICKBOOKS] Error searching for invoice: {str(e)}")
+        log.warning("[QUICKBOOKS] Error searching for invoice: %s", e)
         return None
 
 
-def add_line_to_invoice(access_token, realm_id, invoice, service, session_date, check_in_id):
-    """Add a new line to an existing invoice"""
+def add_line_to_invoice(access_token, realm_id, invoice, qb_item_id, service, session_day, check_in_id):
+    """
+    Add a new line to an existing invoice
+
+    Raises:
+        QuickBooksInvalidRef: QuickBooks rejected the item (or the invoice's
+            customer) as deleted/invalid
+    """
+    invalid = None
     try:
         invoice_id = invoice['Id']
         sync_token = invoice['SyncToken']
-        
-        # Find or create the service item in QuickBooks
-        qb_item_id = find_or_create_qb_item(access_token, realm_id, service)
-        if not qb_item_id:
-            print("[QUICKBOOKS] Failed to find/create item")
-            return None
 
         # Prepare new line
         new_line = {
@@ -165,21 +254,15 @@ def add_line_to_invoice(access_token, realm_id, invoice, service, session_date,
                 "UnitPrice": service.price,
                 "Qty": 1
             },
-            "Description": f"{service.name} - Check-in #{check_in_id} ({session_date.strftime('%Y-%m-%d')})"
+            "Description": f"{service.name} - Check-in #{check_in_id} ({session_day})"
         }
 
-        # Add new line to existing lines
+        # Add new line to existing lines. QuickBooks replaces the whole Line
+        # array on update, so the existing item lines are sent back; the
+        # subtotal line is left out and recomputed server-side
         existing_lines = invoice.get("Line", [])
-        # Filter out subtotal lines
         item_lines = [line for line in existing_lines if line.get("DetailType") == "SalesItemLineDetail"]
         item_lines.append(new_line)
-        
-        # Add subtotal line
-        item_lines.append({
-            "DetailType": "SubTotalLineDetail",
-            "Amount": sum(float(line.get("Amount", 0)) for line in item_lines),
-            "SubTotalLineDetail": {}
-        })
 
         # Update invoice
         update_data = {
@@ -189,47 +272,43 @@ def add_line_to_invoice(access_token, realm_id, invoice, service, session_date,
             "sparse": True
         }
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
+        headers = qb_headers(access_token)
 
         url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/invoice?minorversion=65"
-        response = requests.post(url, headers=headers, json=update_data)
+        response = qb_session.post(url, headers=headers, json=update_data)
 
         if response.status_code == 200:
-            updated_invoice = response.json().get("Invoice", {})
-            print(f"[QUICKBOOKS] ✓ Line added successfully to invoice {invoice_id}")
+            updated_invoice = qb_json(response).get("Invoice", {})
+            log.info("[QUICKBOOKS] ✓ Line added successfully to invoice %s", invoice_id)
             return invoice_id
         else:
-            print(f"[QUICKBOOKS] Error adding line: {response.status_code} - {response.text}")
-            return None
+            log.warning("[QUICKBOOKS] Error adding line: %s - %s", response.status_code, response.text)
+            invalid = qb_invalid_refs(response)
 
     except Exception as e:
-        print(f"[QUICKBOOKS] Error adding line to invoice: {str(e)}")
-        return None
+        log.warning("[QUICKBOOKS] Error adding line to invoice: %s", e)
 
+    if invalid:
+        raise QuickBooksInvalidRef(invalid)
+    return None
 
-def create_new_invoice(access_token, realm_id, customer, service, session_date, check_in_id):
-    """Create a new QuickBooks invoice"""
-    try:
-        # Find or create customer
-        qb_customer_id = find_or_create_qb_customer(access_token, realm_id, customer)
-        if not qb_customer_id:
-            return None
 
-        # Find or create item
-        qb_item_id = find_or_create_qb_item(access_token, realm_id, service)
-        if not qb_item_id:
-            return None
+def create_new_invoice(access_token, realm_id, qb_customer_id, qb_item_id, service, session_day, check_in_id):
+    """
+    Create a new QuickBooks invoice
 
+    Raises:
+        QuickBooksInvalidRef: QuickBooks rejected the customer or item as
+            deleted/invalid
+    """
+    invalid = None
+    try:
         # Create invoice
         invoice_data = {
             "CustomerRef": {
                 "value": qb_customer_id
             },
-            "TxnDate": session_date.strftime('%Y-%m-%d'),
+            "TxnDate": session_day,
             "Line": [
                 {
                     "DetailType": "SalesItemLineDetail",
@@ -246,117 +325,23 @@ def create_new_invoice(access_token, realm_id, customer, service, session_date,
             ]
         }
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
+        headers = qb_headers(access_token)
 
         url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/invoice?minorversion=65"
-        response = requests.post(url, headers=headers, json=invoice_data)
+        response = qb_session.post(url, headers=headers, json=invoice_data)
 
         if response.status_code == 200:
-            invoice = response.json().get("Invoice", {})
+            invoice = qb_json(response).get("Invoice", {})
             invoice_id = invoice.get("Id")
-            print(f"[QUICKBOOKS] ✓ New invoice created successfully! ID: {invoice_id}")
+            log.info("[QUICKBOOKS] ✓ New invoice created successfully! ID: %s", invoice_id)
             return invoice_id
         else:
-            print(f"[QUICKBOOKS] Error creating invoice: {response.status_code} - {response.text}")
-            return None
+            log.warning("[QUICKBOOKS] Error creating invoice: %s - %s", response.status_code, response.text)
+            invalid = qb_invalid_refs(response)
 
     except Exception as e:
-        print(f"[QUICKBOOKS] Error creating invoice: {str(e)}")
-        return None
-
+        log.warning("[QUICKBOOKS] Error creating invoice: %s", e)
 
-def find_or_create_qb_customer(access_token, realm_id, customer):
-    """Find or create customer in QuickBooks"""
-    try:
-        # Search for existing customer
-        query = f"SELECT * FROM Customer WHERE DisplayName = '{customer.firstName} {customer.lastName}'"
-        
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json"
-        }
-        
-        url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-        response = requests.get(url, headers=headers, params={"query": query})
-        
-        if response.status_code == 200:
-            data = response.json()
-            customers = data.get("QueryResponse", {}).get("Customer", [])
-            if customers:
-                return customers[0]["Id"]
-
-        # Create new customer
-        customer_data = {
-            "DisplayName": f"{customer.firstName} {customer.lastName}",
-            "GivenName": customer.firstName,
-            "FamilyName": customer.lastName,
-            "PrimaryEmailAddr": {
-                "Address": customer.email
-            }
-        }
-
-        if customer.phone:
-            customer_data["PrimaryPhone"] = {
-                "FreeFormNumber": customer.phone
-            }
-
-        url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/customer?minorversion=65"
-        response = requests.post(url, headers={**headers, "Content-Type": "application/json"}, json=customer_data)
-
-        if response.status_code == 200:
-            new_customer = response.json().get("Customer", {})
-            return new_customer.get("Id")
-
-        return None
-
-    except Exception as e:
-        print(f"[QUICKBOOKS] Error finding/creating customer: {str(e)}")
-        return None
-
-
-def find_or_create_qb_item(access_token, realm_id, service):
-    """Find or create service item in QuickBooks"""
-    try:
-        # Search for existing item
-        query = f"SELECT * FROM Item WHERE Name = '{service.name}'"
-        
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Accept": "application/json"
-        }
-        
-        url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-        response = requests.get(url, headers=headers, params={"query": query})
-        
-        if response.status_code == 200:
-            data = response.json()
-            items = data.get("QueryResponse", {}).get("Item", [])
-            if items:
-                return items[0]["Id"]
-
-        # Create new item
-        item_data = {
-            "Name": service.name,
-            "Type": "Service",
-            "IncomeAccountRef": {
-                "value": "1"  # Default income account
-            },
-            "UnitPrice": service.price
-        }
-
-        url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/item?minorversion=65"
-        response = requests.post(url, headers={**headers, "Content-Type": "application/json"}, json=item_data)
-
-        if response.status_code == 200:
-            new_item = response.json().get("Item", {})
-            return new_item.get("Id")
-
-        return None
-
-    except Exception as e:
-        print(f"[QUICKBOOKS] Error finding/creating item: {str(e)}")
-        return None
+    if invalid:
+        raise QuickBooksInvalidRef(invalid)
+    return None
@@ -1,24 +1,47 @@
-from flask import Blueprint, jsonify
-from models.models import SessionType
+from flask import Blueprint, jsonify, request, current_app
+import hashlib
+import logging
+from utils.service_cache import get_services
 
 sessiontype_bp = Blueprint('sessiontype_bp', __name__)
 
+log = logging.getLogger(__name__)
+
+# (services, body, etag) for the last service list served. get_services()
+# returns the same list object until its cache reloads, so an identity check
+# is enough to know when the body must be rebuilt.
+_cached_response = (None, None, None)
+
 @sessiontype_bp.route("/api/session-types", methods=["GET"])
 def get_session_types():
     """Get all session types"""
+    global _cached_response
     try:
-        session_types = SessionType.query.all()
-        result = []
-        
-        for st in session_types:
-            result.append({
-                "id": st.id,
-                "name": st.name,
-                "price": float(st.price)
-            })
-        
-        return jsonify(result), 200
-        
-    except Exception as e:
-        print(f"[ERROR] Failed to get session types: {str(e)}")
+        services = get_services()
+
+        cached = _cached_response
+        if cached[0] is not services:
+            result = []
+
+            for st in services:
+                result.append({
+                    "id": st["id"],
+                    "name": st["name"],
+                    "price": float(st["price"])
+                })
+
+            # Kept as bytes so responses don't re-encode the body each time
+            body = current_app.json.dumps(result).encode()
+            # The ETag is only a change marker, so FIPS-mode hosts must
+            # not reject the digest
+            etag = hashlib.md5(body, usedforsecurity=False).hexdigest()
+            cached = _cached_response = (services, body, etag)
+
+        response = current_app.response_class(cached[1], mimetype="application/json")
+        response.set_etag(cached[2])
+        # 304 Not Modified when the client already has this list
+        return response.make_conditional(request)
+
+    except Exception:
+        log.exception("Failed to get session types")
         return jsonify({"error": "Failed to retrieve session types"}), 500
@@ -1,11 +1,10 @@
 from flask import Blueprint, send_from_directory
-import os
+from routes.pages_routes import STATIC_FOLDER, PAGE_MAX_AGE
 
 simple_checkin_bp = Blueprint("simple_checkin_bp", __name__)
 
 @simple_checkin_bp.route("/check-in", methods=["GET"])
 def simple_checkin_page():
     """Serve the simple check-in HTML page"""
-    # Get the static folder path
-    static_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
-    return send_from_directory(static_folder, 'checkin_simple.html')
+    # Cacheable and revalidated like the other pages (304 when unchanged)
+    return send_from_directory(STATIC_FOLDER, 'checkin_simple.html', max_age=PAGE_MAX_AGE, conditional=True)
@@ -0,0 +1,41 @@
+"""
+Canonical list of services (session types)
+Single source of truth used by the initial seed in main.py, the admin
+import endpoint and the import_services.py script
+
+Names match the QuickBooks products/services exactly
+Basé sur: ProductsServicesList_Doulos_Éducation_07_02_2026.csv
+"""
+
+# Predefined services list - NOMS QUICKBOOKS EXACTS
+SERVICES = (
+    # Tutorat individuel (40$)
+    {"name": "Individuel (En ligne)", "duration": 60, "price": 40.00},
+    {"name": "Individuel (présentiel)", "duration": 60, "price": 40.00},  # MODIFIÉ: "En personne" → "présentiel"
+    
+    # Tutorat groupe (21$)
+    {"name": "Groupe (4-5) (En personne)", "duration": 60, "price": 21.00},
+    {"name": "Grand groupe (6+) (En personne)", "duration": 60, "price": 21.00},
+    {"name": "Groupe Français", "duration": 60, "price": 21.00},  # AJOUTÉ
+    {"name": "Groupe Mathématiques", "duration": 60, "price": 21.00},  # AJOUTÉ
+    {"name": "Groupe mathématiques et Français", "duration": 60, "price": 21.00},  # AJOUTÉ
+    
+    # Tutorat sous-groupe (27$)
+    {"name": "Sous groupe (Maths + Francais)", "duration": 60, "price": 27.00},  # AJOUTÉ
+    
+    # Musique (27$) - NOMS MODIFIÉS POUR CORRESPONDRE À QUICKBOOKS
+    {"name": "Cours de piano", "duration": 30, "price": 27.00},  # MODIFIÉ: "Piano" → "Cours de piano"
+    {"name": "Cours de Guitare", "duration": 30, "price": 27.00},  # MODIFIÉ: "Guitare" → "Cours de Guitare"
+    {"name": "Cours de chant", "duration": 30, "price": 27.00},  # MODIFIÉ: "Chant" → "Cours de chant"
+    {"name": "Cours de Batterie", "duration": 30, "price": 27.00},  # MODIFIÉ: "Batterie" → "Cours de Batterie"
+    
+    # Absences (21$)
+    {"name": "Absence Motivée", "duration": 60, "price": 21.00},  # AJOUTÉ
+    {"name": "Absence non motivée", "duration": 60, "price": 21.00},  # AJOUTÉ
+    
+    # Spéciaux (0$)
+    {"name": "Cours annulé", "duration": 60, "price": 0.00},  # AJOUTÉ
+    {"name": "Heures", "duration": 60, "price": 0.00}
+)
+
+SERVICE_NAMES = frozenset(s["name"] for s in SERVICES)
@@ -0,0 +1,28 @@
+"""
+Email Address Validation
+Cheap shape check for recipient addresses, run before any QR rendering or
+email provider call.
+"""
+
+import re
+
+# Basic address shape: local@domain.tld, no spaces
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+# Longest valid address (RFC 5321 path limit minus the angle brackets); also
+# bounds the regex on hostile input
+MAX_EMAIL_LENGTH = 254
+
+
+def is_valid_email(address):
+    """
+    Check that a value looks like a single email address
+
+    Args:
+        address: Value from the request body (may not be a string)
+
+    Returns:
+        bool: True if it is a string of at most MAX_EMAIL_LENGTH characters
+        matching local@domain.tld with no whitespace
+    """
+    return isinstance(address, str) and len(address) <= MAX_EMAIL_LENGTH and _EMAIL_RE.fullmatch(address) is not None
@@ -0,0 +1,126 @@
+"""
+Invoice Numbers
+Works out the number that follows QuickBooks' last DocNumber, and hands
+numbers out atomically through the database so two check-ins creating
+invoices at the same time (in any worker) can't both use the same one.
+
+A number is claimed before the QuickBooks create (the create can't join the
+database transaction). If QuickBooks definitely didn't create the invoice,
+the number is released again; it can only be reused while no later number has
+been handed out, so a failed create can still leave a gap in the sequence.
+"""
+
+import logging
+import re
+from datetime import datetime
+from sqlalchemy import case, update
+from db import db
+from models.models import InvoiceCounter
+
+log = logging.getLogger(__name__)
+
+# Optional prefix followed by the number to increment, e.g. "INV-" + "0042"
+_DOC_NUMBER_RE = re.compile(r"^(.*?)(\d+)$")
+
+
+def next_invoice_number(last_doc_number):
+    """
+    Work out the invoice number that follows the last one used in QuickBooks
+
+    Args:
+        last_doc_number (str): DocNumber of the most recent invoice, or None
+
+    Returns:
+        str: Last number + 1 keeping its prefix and width ("1001" -> "1002",
+            "INV-0099" -> "INV-0100"), or a date/time based number if there
+            is nothing to increment
+    """
+    log.debug("[INVOICE_NUMBER] Last invoice number found: %s", last_doc_number)
+
+    match = _DOC_NUMBER_RE.match(last_doc_number or "")
+    if match:
+        prefix, digits = match.groups()
+        result = f"{prefix}{str(int(digits) + 1).zfill(len(digits))}"
+        log.debug("[INVOICE_NUMBER] Generated next number: %s", result)
+        return result
+
+    # Fallback: Generate based on date/time
+    invoice_number = datetime.now().strftime("%Y%m%d-%H%M%S")
+    log.info("[INVOICE_NUMBER] Generated fallback number: %s", invoice_number)
+    return invoice_number
+
+
+def claim_invoice_number(realm_id, candidate):
+    """
+    Reserve an invoice number for a new QuickBooks invoice
+
+    QuickBooks stays the source of truth: the candidate (next number after its
+    last DocNumber) is used unless this app already handed it out, in which
+    case the number after the last one handed out is used instead. One
+    INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement, committed on
+    its own connection so the row lock isn't held during the QuickBooks call.
+
+    Args:
+        realm_id (str): QuickBooks company/realm ID
+        candidate (str): Number worked out from QuickBooks' last DocNumber
+
+    Returns:
+        str: Number to use (the candidate itself if it has no numeric part)
+    """
+    match = _DOC_NUMBER_RE.match(candidate or "")
+    if not match:
+        return candidate
+    prefix, digits = match.groups()
+
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    table = InvoiceCounter.__table__
+    stmt = dialect_insert(table).values(key=f"{realm_id}:{prefix}", last_number=int(digits))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={"last_number": case(
+            (table.c.last_number >= stmt.excluded.last_number, table.c.last_number + 1),
+            else_=stmt.excluded.last_number
+        )}
+    ).returning(table.c.last_number)
+
+    with db.engine.begin() as connection:
+        number = connection.execute(stmt).scalar_one()
+
+    # Preserve leading zeros
+    return f"{prefix}{str(number).zfill(len(digits))}"
+
+
+def release_invoice_number(realm_id, number):
+    """
+    Give back a number claimed for an invoice QuickBooks didn't create
+
+    Only undoes the claim while it is still the last number handed out for
+    its prefix (compare-and-set): once another invoice has claimed the next
+    one, the released number stays unused.
+
+    Args:
+        realm_id (str): QuickBooks company/realm ID
+        number (str): Number returned by claim_invoice_number()
+    """
+    match = _DOC_NUMBER_RE.match(number or "")
+    if not match:
+        return
+    prefix, digits = match.groups()
+
+    table = InvoiceCounter.__table__
+    stmt = update(table).where(
+        table.c.key == f"{realm_id}:{prefix}",
+        table.c.last_number == int(digits)
+    ).values(last_number=int(digits) - 1)
+
+    with db.engine.begin() as connection:
+        released = connection.execute(stmt).rowcount
+
+    if released:
+        log.debug("[INVOICE_NUMBER] Released unused number: %s", number)
+    else:
+        log.info("[INVOICE_NUMBER] %s was not used - a later number is already out, leaving a gap", number)
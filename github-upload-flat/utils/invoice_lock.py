@@ -0,0 +1,29 @@
+"""
+Monthly Invoice Lock
+Serializes the find-or-create of a customer's monthly QuickBooks invoice, so
+two check-ins for the same customer and month (in any worker) can't both
+find no invoice and create two.
+"""
+
+from sqlalchemy import text
+from db import db
+
+
+def lock_monthly_invoice(customer_id, invoice_date):
+    """
+    Take the lock for a customer's invoice of a given month
+
+    Uses a PostgreSQL transaction-level advisory lock keyed by
+    (customer_id, yyyymm): it is released by the caller's commit or rollback.
+    No-op on other databases.
+
+    Args:
+        customer_id (int): Local customer ID
+        invoice_date (datetime): Any date in the invoice's month
+    """
+    if db.engine.dialect.name != "postgresql":
+        return
+    db.session.execute(
+        text("SELECT pg_advisory_xact_lock(:customer_id, :month)"),
+        {"customer_id": customer_id, "month": invoice_date.year * 100 + invoice_date.month}
+    )
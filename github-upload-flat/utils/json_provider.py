@@ -0,0 +1,59 @@
+"""
+orjson JSON Provider
+Flask JSON provider that serializes jsonify() responses and parses request
+bodies with orjson (C, several times faster than the stdlib json module).
+
+Output matches Flask's default provider: keys are sorted, dates use the
+same HTTP date format and Decimal/UUID/dataclass values go through Flask's
+own fallback. Calls that pass json.dumps/json.loads options are handed to
+the default provider unchanged.
+"""
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not available, keeping Flask's stdlib json provider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """DefaultJSONProvider with orjson doing the actual work"""
+
+    def _option(self):
+        # Dates go to Flask's default() so they keep the HTTP date format;
+        # int dict keys are allowed as with the stdlib module
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            # Indented output for debugging
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._option() | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_json_provider(app):
+    """
+    Use orjson for the app's JSON when it is installed
+
+    Args:
+        app (Flask): Application to configure
+    """
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,70 @@
+"""
+QuickBooks Reference Cache
+In-process TTL cache for QuickBooks Customer/Item refs, keyed by
+(realm_id, entity, name). Refs almost never change once created, so repeat
+check-ins and manual sessions can skip the QBO lookup entirely.
+"""
+
+import threading
+import time
+
+# How long a ref is trusted before it is looked up again
+QB_REF_CACHE_TTL = 24 * 3600
+
+# Open monthly invoices change with every check-in, so they are only
+# trusted for a short while (see create_or_update_monthly_invoice)
+QB_INVOICE_CACHE_TTL = 60
+
+# Upper bound on cached refs per process
+QB_REF_CACHE_MAXSIZE = 4096
+
+_qb_ref_cache = {}
+_qb_ref_cache_lock = threading.Lock()
+
+
+def get_cached_ref(key):
+    """
+    Get a cached QuickBooks ref
+
+    Args:
+        key (tuple): (realm_id, entity, name)
+
+    Returns:
+        The cached ref, or None if missing or expired
+    """
+    entry = _qb_ref_cache.get(key)
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
+    return None
+
+
+def cache_ref(key, ref, ttl=QB_REF_CACHE_TTL):
+    """
+    Remember a QuickBooks ref for ttl seconds
+
+    Args:
+        key (tuple): (realm_id, entity, name)
+        ref: Ref to cache (dict or ID string)
+        ttl (int): Seconds before the ref is looked up again
+    """
+    now = time.monotonic()
+    with _qb_ref_cache_lock:
+        if len(_qb_ref_cache) >= QB_REF_CACHE_MAXSIZE:
+            # Drop expired entries first, then the oldest ones
+            for stale in [k for k, (_, expires) in _qb_ref_cache.items() if expires <= now]:
+                del _qb_ref_cache[stale]
+            while len(_qb_ref_cache) >= QB_REF_CACHE_MAXSIZE:
+                del _qb_ref_cache[next(iter(_qb_ref_cache))]
+        _qb_ref_cache[key] = (ref, now + ttl)
+
+
+def forget_ref(*keys):
+    """
+    Drop refs that turned out to be stale (e.g. deleted in QuickBooks)
+
+    Args:
+        *keys (tuple): Cache keys to remove
+    """
+    with _qb_ref_cache_lock:
+        for key in keys:
+            _qb_ref_cache.pop(key, None)
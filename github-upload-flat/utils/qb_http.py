@@ -0,0 +1,407 @@
+"""
+QuickBooks HTTP Helpers
+Shared requests.Session so every QuickBooks call reuses pooled keep-alive
+connections instead of paying a new TCP + TLS handshake per request, and
+escaping for values interpolated into QBO queries.
+
+Every call gets a default (connect, read) timeout, and a simple circuit
+breaker stops calling QuickBooks for a while after repeated failures so an
+outage can't tie up every worker thread.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not available, using requests' stdlib json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.qb_cache import get_cached_ref, cache_ref
+
+
+log = logging.getLogger(__name__)
+
+# Default (connect, read) timeout in seconds for QuickBooks calls
+QB_TIMEOUT = (3.05, 10)
+
+# Retries on connection errors, 429 (QBO throttling) and 5xx, with
+# exponential backoff (0.5s, 1s, 2s, ...) or the server's Retry-After
+QB_RETRY_TOTAL = 5
+
+# Income account used when creating service items
+_QUERY_INCOME_ACCOUNT = "SELECT Id FROM Account WHERE AccountType = 'Income' MAXRESULTS 1"
+
+# Customer/item lookups - values are escaped with qbo_escape() before formatting
+_QUERY_CUSTOMER = "SELECT Id FROM Customer WHERE DisplayName = '{}'"
+_QUERY_ITEM = "SELECT Id FROM Item WHERE Name = '{}'"
+
+# Circuit breaker: after QB_BREAKER_FAIL_MAX consecutive failures, fail fast
+# for QB_BREAKER_RESET_SECONDS before trying QuickBooks again
+QB_BREAKER_FAIL_MAX = 5
+QB_BREAKER_RESET_SECONDS = 60
+
+# QBO fault codes for a reference to an entity that doesn't exist (any more):
+# 610 Object Not Found, 2500 Invalid Reference Id (deleted or inactive)
+_INVALID_REF_CODES = frozenset(["610", "2500"])
+
+
+class QuickBooksUnavailable(requests.exceptions.ConnectionError):
+    """Raised instead of calling QuickBooks while the circuit is open"""
+
+
+class QuickBooksInvalidRef(Exception):
+    """Raised when QuickBooks rejects a write because a CustomerRef/ItemRef is invalid"""
+
+    def __init__(self, entities):
+        super().__init__(f"Invalid QuickBooks reference: {', '.join(sorted(entities))}")
+        self.entities = entities
+
+
+class QBSession(requests.Session):
+    """requests.Session with a default timeout and a circuit breaker"""
+
+    def __init__(self):
+        super().__init__()
+        self._failures = 0
+        self._open_until = 0.0
+        self._breaker_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        if self._open_until > time.monotonic():
+            raise QuickBooksUnavailable("QuickBooks circuit open - skipping call")
+
+        kwargs.setdefault("timeout", QB_TIMEOUT)
+        if method.upper() == "POST":
+            # QBO de-duplicates writes that carry the same requestid, so a POST
+            # retried by the adapter can't create a second invoice/customer
+            params = dict(kwargs.get("params") or {})
+            params.setdefault("requestid", uuid.uuid4().hex)
+            kwargs["params"] = params
+        if orjson is not None and kwargs.get("json") is not None:
+            # Serialize the body with orjson (bytes, no re-encode) instead of
+            # letting requests run it through the stdlib json module
+            kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+            headers = kwargs.get("headers") or {}
+            if "Content-Type" not in headers:
+                kwargs["headers"] = {**headers, "Content-Type": "application/json"}
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record_result(False)
+            raise
+
+        self._record_result(response.status_code < 500)
+        return response
+
+    def _record_result(self, ok):
+        with self._breaker_lock:
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= QB_BREAKER_FAIL_MAX:
+                log.warning("[QUICKBOOKS] %s failures in a row - pausing calls for %ss", self._failures, QB_BREAKER_RESET_SECONDS)
+                self._open_until = time.monotonic() + QB_BREAKER_RESET_SECONDS
+                self._failures = 0
+
+
+def create_qb_session(pool_connections=10, pool_maxsize=50):
+    """
+    Build a requests.Session with a pooled HTTPS adapter
+
+    Args:
+        pool_connections (int): Number of host pools to keep
+        pool_maxsize (int): Maximum connections kept alive per host
+
+    Returns:
+        QBSession: Session with JSON Accept header, default timeout, circuit
+            breaker and idempotent retries on transient errors
+    """
+    session = QBSession()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=QB_RETRY_TOTAL,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # POST is safe to retry because every POST carries a requestid
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+# Connections are opened lazily, so creating this in the preloaded master is safe:
+# each gunicorn worker fills its own pool after fork
+qb_session = create_qb_session()
+
+
+def qbo_escape(value):
+    """
+    Escape a value for use inside a quoted QBO query literal
+
+    Args:
+        value (str): Raw value (e.g. a display name such as "O'Brien")
+
+    Returns:
+        str: Value with backslashes and single quotes escaped
+    """
+    return str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+
+@functools.lru_cache(maxsize=4)
+def qb_headers(access_token):
+    """
+    Get the request headers for a QuickBooks call
+
+    Built once per access token (tokens only rotate every hour), so every
+    call in an invoice flow reuses the same dict. Callers must not modify it.
+
+    Args:
+        access_token (str): OAuth access token
+
+    Returns:
+        dict: Authorization and Content-Type headers
+    """
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+
+def qb_json(response):
+    """
+    Decode a QuickBooks JSON response body
+
+    Args:
+        response (requests.Response): Response from a QuickBooks call
+
+    Returns:
+        dict: Parsed body (with orjson when installed, several times faster
+            than the stdlib parser on large Invoice payloads)
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def qb_invalid_refs(response):
+    """
+    Get the entities a failed QuickBooks write rejected as invalid references
+
+    Only validation faults about a missing/deleted Customer or Item count;
+    stale SyncTokens, throttling and server errors return an empty set, so
+    callers keep IDs that are still good.
+
+    Args:
+        response (requests.Response): Failed response from a QuickBooks write
+
+    Returns:
+        set: "Customer" and/or "Item"
+    """
+    try:
+        errors = qb_json(response).get("Fault", {}).get("Error", [])
+    except ValueError:
+        return set()
+
+    entities = set()
+    for error in errors:
+        if str(error.get("code")) not in _INVALID_REF_CODES:
+            continue
+        text = f"{error.get('element', '')} {error.get('Detail', '')}".lower()
+        if "customer" in text:
+            entities.add("Customer")
+        if "item" in text:
+            entities.add("Item")
+    return entities
+
+
+def get_income_account_id(access_token, realm_id, api_url):
+    """
+    Get the income account to attach to new service items
+
+    Uses QB_INCOME_ACCOUNT_ID when set. Otherwise the realm's first income
+    account is looked up once and cached, so creating items doesn't cost an
+    extra QuickBooks query each time.
+
+    Args:
+        access_token (str): OAuth access token
+        realm_id (str): QuickBooks company/realm ID
+        api_url (str): QuickBooks API base URL (sandbox or production)
+
+    Returns:
+        str: Account ID ("1" if the lookup fails, as before)
+    """
+    configured = os.environ.get("QB_INCOME_ACCOUNT_ID")
+    if configured:
+        return configured
+
+    key = (realm_id, "Account", "Income")
+    account_id = get_cached_ref(key)
+    if account_id:
+        return account_id
+
+    try:
+        response = qb_session.get(
+            f"{api_url}/v3/company/{realm_id}/query",
+            headers=qb_headers(access_token),
+            params={"query": _QUERY_INCOME_ACCOUNT}
+        )
+        if response.status_code == 200:
+            accounts = qb_json(response).get("QueryResponse", {}).get("Account", [])
+            if accounts:
+                account_id = accounts[0]["Id"]
+                cache_ref(key, account_id)
+                return account_id
+        log.warning("[QUICKBOOKS] No income account found - using default account 1")
+    except Exception as e:
+        log.warning("[QUICKBOOKS] Error looking up income account: %s", e)
+    return "1"
+
+
+def qb_batch(operations, access_token, realm_id, api_url):
+    """
+    Send several QBO operations in a single batch request
+
+    Args:
+        operations (list): BatchItemRequest entries, each with a unique "bId"
+        access_token (str): OAuth access token
+        realm_id (str): QuickBooks company/realm ID
+        api_url (str): QuickBooks API base URL (sandbox or production)
+
+    Returns:
+        dict: BatchItemResponse entries keyed by bId, or None if the request failed
+    """
+    response = qb_session.post(
+        f"{api_url}/v3/company/{realm_id}/batch",
+        headers=qb_headers(access_token),
+        json={"BatchItemRequest": operations}
+    )
+
+    if response.status_code != 200:
+        log.warning("[QUICKBOOKS] Batch request failed: %s - %s", response.status_code, response.text)
+        return None
+
+    return {item.get("bId"): item for item in qb_json(response).get("BatchItemResponse", [])}
+
+
+def resolve_qb_refs(customer, session_type, access_token, realm_id, api_url):
+    """
+    Find or create the QuickBooks customer and service item for a check-in
+    or manual session
+
+    IDs saved on the customer/session type rows (or cached in this process)
+    are used as-is. The rest are looked up with one batch query, and whatever
+    QuickBooks doesn't have yet is created with one batch create - so a
+    check-in costs at most two round trips here instead of up to four. The
+    resolved IDs are set on the rows and saved with the caller's commit.
+
+    Args:
+        customer (Customer): Customer being invoiced
+        session_type (SessionType): Service being invoiced
+        access_token (str): OAuth access token
+        realm_id (str): QuickBooks company/realm ID
+        api_url (str): QuickBooks API base URL (sandbox or production)
+
+    Returns:
+        tuple: (customer_ref, item_ref) - either may be None on failure
+    """
+    try:
+        names = {
+            "Customer": f"{customer.firstName} {customer.lastName}",
+            "Item": session_type.name
+        }
+        queries = {
+            "Customer": _QUERY_CUSTOMER.format(qbo_escape(names["Customer"])),
+            "Item": _QUERY_ITEM.format(qbo_escape(names["Item"]))
+        }
+        cache_keys = {entity: (realm_id, entity, name) for entity, name in names.items()}
+        saved_ids = {"Customer": customer.qb_customer_id, "Item": session_type.qb_item_id}
+        refs = {
+            entity: {"value": saved_ids[entity], "name": names[entity]} if saved_ids[entity] else get_cached_ref(key)
+            for entity, key in cache_keys.items()
+        }
+
+        # Look up everything that isn't cached in one round trip
+        missing = [entity for entity, ref in refs.items() if not ref]
+        if missing:
+            log.debug("[QUICKBOOKS] Searching for %s", missing)
+            results = qb_batch([{"bId": e, "Query": queries[e]} for e in missing], access_token, realm_id, api_url)
+            if results is None:
+                return None, None
+
+            for entity in missing:
+                found = results.get(entity, {}).get("QueryResponse", {}).get(entity, [])
+                if found:
+                    refs[entity] = {"value": found[0].get("Id"), "name": names[entity]}
+                    log.debug("[QUICKBOOKS] Found existing %s: %s (ID: %s)", entity, names[entity], refs[entity]['value'])
+
+        # Create whatever QuickBooks doesn't have yet in one round trip
+        missing = [entity for entity, ref in refs.items() if not ref]
+        if missing:
+            income_account_id = get_income_account_id(access_token, realm_id, api_url) if "Item" in missing else None
+            bodies = {
+                "Customer": {
+                    "DisplayName": names["Customer"],
+                    "GivenName": customer.firstName,
+                    "FamilyName": customer.lastName,
+                    "PrimaryEmailAddr": {"Address": customer.email} if customer.email else None,
+                    "PrimaryPhone": {"FreeFormNumber": customer.phone} if customer.phone else None
+                },
+                "Item": {
+                    "Name": names["Item"],
+                    "Type": "Service",
+                    "IncomeAccountRef": {
+                        "value": income_account_id
+                    },
+                    "UnitPrice": float(session_type.price)
+                }
+            }
+
+            log.debug("[QUICKBOOKS] Not found, creating new: %s", missing)
+            results = qb_batch([
+                {
+                    "bId": e,
+                    "operation": "create",
+                    # Remove None values
+                    e: {k: v for k, v in bodies[e].items() if v is not None}
+                }
+                for e in missing
+            ], access_token, realm_id, api_url)
+            if results is None:
+                return None, None
+
+            for entity in missing:
+                created = results.get(entity, {}).get(entity)
+                if created:
+                    refs[entity] = {"value": created.get("Id"), "name": names[entity]}
+                    log.info("[QUICKBOOKS] ✓ %s created: %s (ID: %s)", entity, names[entity], refs[entity]['value'])
+                else:
+                    log.warning("[QUICKBOOKS] Failed to create %s: %s", entity, results.get(entity, {}).get('Fault'))
+
+        for entity, ref in refs.items():
+            if ref:
+                cache_ref(cache_keys[entity], ref)
+
+        if refs["Customer"]:
+            customer.qb_customer_id = refs["Customer"]["value"]
+        if refs["Item"]:
+            session_type.qb_item_id = refs["Item"]["value"]
+
+        return refs["Customer"], refs["Item"]
+
+    except Exception as e:
+        log.warning("[QUICKBOOKS] Error finding/creating customer and item: %s", e)
+        return None, None
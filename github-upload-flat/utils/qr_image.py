@@ -0,0 +1,57 @@
+"""
+QR Code Images
+Renders the customer QR codes attached to registration emails as PNG bytes.
+"""
+
+import functools
+import io
+import qrcode
+
+try:
+    import segno  # writes the PNG directly, no PIL raster
+except ImportError:
+    segno = None  # segno not available, rendering with qrcode + PIL
+
+# segno error levels mapped to the qrcode constants for the fallback path
+_QRCODE_ERROR_LEVELS = {
+    "l": qrcode.constants.ERROR_CORRECT_L,
+    "m": qrcode.constants.ERROR_CORRECT_M,
+    "q": qrcode.constants.ERROR_CORRECT_Q,
+    "h": qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def generate_qr_code_png(data_string, error="m"):
+    """
+    Generate QR code and return the PNG bytes
+
+    Cached per data string and error level (bytes are immutable, so sharing
+    them is safe): re-sending a customer's email doesn't render the same
+    code again.
+
+    Args:
+        data_string (str): Data to encode
+        error (str): Error correction level - "l", "m", "q" or "h"
+
+    Returns:
+        bytes: PNG image, 10px modules with a 4-module border
+    """
+    # Both paths write a 1-bit PNG; zlib level 1 is nearly as small on the
+    # long runs of a QR raster and much cheaper than the default level
+    buffer = io.BytesIO()
+    if segno is not None:
+        segno.make_qr(data_string, error=error, boost_error=False).save(buffer, kind='png', scale=10, border=4, compresslevel=1)
+        return buffer.getvalue()
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=_QRCODE_ERROR_LEVELS[error],
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data_string)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    img.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
@@ -0,0 +1,66 @@
+"""
+Service (SessionType) Cache
+Short-lived in-process copy of the session_types table. There are only a
+handful of services and they rarely change, so list endpoints and the
+check-in lookup read from here instead of querying on every request.
+Every handler that modifies services calls invalidate_services().
+"""
+
+import time
+from models.models import SessionType
+
+SERVICES_CACHE_TTL = 30  # seconds
+_services_cache = {"data": None, "by_id": None, "ts": 0.0}
+
+
+def _load_services():
+    services = SessionType.query.order_by(SessionType.id).all()
+    data = [{
+        "id": s.id,
+        "name": s.name,
+        "price": s.price,
+        "duration": s.duration,
+        "created_at": s.created_at.isoformat() if s.created_at else None
+    } for s in services]
+
+    _services_cache["by_id"] = {s["id"]: s for s in data}
+    _services_cache["data"] = data
+    _services_cache["ts"] = time.time()
+    return data
+
+
+def get_services():
+    """
+    Get every service as a list of dicts (must run inside an app context)
+
+    Returns:
+        list: Services ordered by ID, each with id, name, price, duration, created_at
+    """
+    data = _services_cache["data"]
+    if data is not None and time.time() - _services_cache["ts"] < SERVICES_CACHE_TTL:
+        return data
+    return _load_services()
+
+
+def get_service(service_id):
+    """
+    Get a single service by ID from the cache
+
+    Args:
+        service_id (int|str): Service ID as received from the client
+
+    Returns:
+        dict: The service, or None if it doesn't exist
+    """
+    try:
+        service_id = int(service_id)
+    except (TypeError, ValueError):
+        return None
+
+    get_services()
+    return _services_cache["by_id"].get(service_id)
+
+
+def invalidate_services():
+    """Drop the cached services so the next read reloads them"""
+    _services_cache["data"] = None
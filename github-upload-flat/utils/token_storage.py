@@ -8,10 +8,29 @@ CHANGEMENTS PRINCIPAUX:
 - Amelioration de la gestion des erreurs
 """
 
+import base64
 import json
+import logging
 import os
+import threading
+import time
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future
+from datetime import datetime
+from urllib.parse import quote_plus
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not available, using the stdlib json module
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no flock (Windows), refreshes are only deduplicated per process
+
+log = logging.getLogger(__name__)
 
 # Token file path - store in persistent location
 TOKEN_FILE_PATH = os.environ.get("QB_TOKEN_FILE", "/tmp/data/qb_token.json")
@@ -21,6 +40,62 @@ QB_CLIENT_ID = os.environ.get("QB_CLIENT_ID", "AB32rXJy5ipKKQaRgwX0ci4v770Ja9B3h
 QB_CLIENT_SECRET = os.environ.get("QB_CLIENT_SECRET", "wmDRQCodu34KTwgeD6DQT3UTLqU3qAwsmPKl6GD1")
 QB_TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 
+# Kept-alive connection to Intuit's token endpoint, so a refresh doesn't pay
+# a new TCP + TLS handshake. No retries: a refresh token is single-use, and
+# re-sending a POST that already reached Intuit would burn it.
+_token_session = requests.Session()
+_token_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+# The client credentials never change, so the Basic auth header is built once
+_TOKEN_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Authorization": "Basic " + base64.b64encode(f"{QB_CLIENT_ID}:{QB_CLIENT_SECRET}".encode()).decode()
+}
+
+# Refreshes in progress, by realm. Intuit refresh tokens are single-use, so
+# concurrent callers wait for the refresh already in flight instead of
+# spending the same refresh token again (and getting invalid_grant).
+# Across gunicorn workers the refresh is serialized with a flock on this file
+TOKEN_LOCK_PATH = TOKEN_FILE_PATH + ".lock"
+QB_REFRESH_WAIT_SECONDS = 15
+_refresh_inflight = {}
+_refresh_inflight_lock = threading.Lock()
+
+# Parsed contents of the token file, reused while the file's mtime is
+# unchanged (other gunicorn workers may rewrite it) - a stat() instead of
+# a read + json.loads on every load_token_from_file()
+_file_cache = {"data": None, "mtime": None}
+_file_cache_lock = threading.RLock()
+
+# In-process copy of the last valid token, keyed by the token file's mtime.
+# refresh_after is its expiry minus the refresh buffer as a time.monotonic()
+# deadline, so the fast path is a float compare (no parsing, no utcnow()).
+# The file is only stat()ed again once recheck_at passes - it catches other
+# gunicorn workers refreshing or disconnecting; changes made by this process
+# reset recheck_at directly
+QB_TOKEN_RECHECK_SECONDS = 5
+_token_cache = {"data": None, "mtime": None, "refresh_after": 0.0, "recheck_at": 0.0}
+_token_cache_lock = threading.Lock()
+
+def _token_file_mtime():
+    try:
+        return os.stat(TOKEN_FILE_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def _dumps(data):
+    """Encode the token file contents, compact (orjson when installed)"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def _loads(raw):
+    """Decode the token file contents (orjson when installed)"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 def save_token_to_file(access_token, refresh_token, realm_id, expires_in):
     """
     Save QuickBooks token to a JSON file
@@ -36,12 +111,12 @@ def save_token_to_file(access_token, refresh_token, realm_id, expires_in):
     """
     try:
         # Ensure directory exists
-        token_dir = os.path.dirname(TOKEN_FILE_PATH)
-        if not os.path.exists(token_dir):
-            os.makedirs(token_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(TOKEN_FILE_PATH), exist_ok=True)
         
-        # Calculate expiration timestamp
-        expires_at = (datetime.utcnow() + timedelta(seconds=expires_in)).isoformat()
+        # Calculate expiration timestamp (Unix time for the validity checks,
+        # ISO string for people reading the file)
+        expires_at_ts = time.time() + expires_in
+        expires_at = datetime.utcfromtimestamp(expires_at_ts).isoformat()
         
         token_data = {
             "access_token": access_token,
@@ -49,18 +124,31 @@ def save_token_to_file(access_token, refresh_token, realm_id, expires_in):
             "realm_id": realm_id,
             "expires_in": expires_in,
             "expires_at": expires_at,
+            "expires_at_ts": expires_at_ts,
             "created_at": datetime.utcnow().isoformat()
         }
         
-        # Write to file
-        with open(TOKEN_FILE_PATH, 'w') as f:
-            json.dump(token_data, f, indent=2)
+        # Write to file - encoded up front so the payload goes out in one write().
+        # Written to a temp file first and renamed over the old one, so a crash
+        # mid-write can't leave a truncated file (and lose the refresh token)
+        payload = _dumps(token_data)
+        tmp_path = f"{TOKEN_FILE_PATH}.{os.getpid()}.tmp"
+        with _file_cache_lock:
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, TOKEN_FILE_PATH)
+            _file_cache["data"] = token_data
+            _file_cache["mtime"] = _token_file_mtime()
+        # No lock: this can run inside get_cached_token() during a refresh
+        _token_cache["recheck_at"] = 0.0
         
-        print(f"Token saved to file: {TOKEN_FILE_PATH}")
+        log.info("Token saved to file: %s", TOKEN_FILE_PATH)
         return True
         
     except Exception as e:
-        print(f"ERROR saving token to file: {str(e)}")
+        log.error("ERROR saving token to file: %s", e)
         return False
 
 def load_token_from_file():
@@ -71,20 +159,62 @@ def load_token_from_file():
         dict: Token data if file exists and is valid, None otherwise
     """
     try:
-        if not os.path.exists(TOKEN_FILE_PATH):
-            print(f"Token file not found: {TOKEN_FILE_PATH}")
-            return None
-        
-        with open(TOKEN_FILE_PATH, 'r') as f:
-            token_data = json.load(f)
+        with _file_cache_lock:
+            mtime = _token_file_mtime()
+            if mtime is None:
+                _file_cache["data"] = None
+                log.info("Token file not found: %s", TOKEN_FILE_PATH)
+                return None
+            
+            if _file_cache["data"] is not None and mtime == _file_cache["mtime"]:
+                # Copy so callers can't modify the cached token
+                return dict(_file_cache["data"])
+            
+            try:
+                f = open(TOKEN_FILE_PATH, 'rb')
+            except FileNotFoundError:
+                # Deleted since the stat() above
+                _file_cache["data"] = None
+                log.info("Token file not found: %s", TOKEN_FILE_PATH)
+                return None
+            with f:
+                # mtime of the file actually read, in case it was replaced
+                # since the stat() above
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+                token_data = _loads(f.read())
+            if 'expires_at_ts' not in token_data and token_data.get('expires_at'):
+                # Saved before expires_at_ts existed - parse the ISO string
+                # once here rather than on every validity check
+                try:
+                    token_data['expires_at_ts'] = _expires_at_ts(token_data)
+                except ValueError:
+                    pass
+            _file_cache["data"] = token_data
+            _file_cache["mtime"] = mtime
         
-        print(f"Token loaded from file for realm: {token_data.get('realm_id')}")
-        return token_data
+        log.debug("Token loaded from file for realm: %s", token_data.get('realm_id'))
+        return dict(token_data)
         
     except Exception as e:
-        print(f"ERROR loading token from file: {str(e)}")
+        log.error("ERROR loading token from file: %s", e)
         return None
 
+def _expires_at_ts(token_data):
+    """
+    Get a token's expiry as Unix time
+
+    Args:
+        token_data (dict): Token data dictionary
+
+    Returns:
+        float: Expiry timestamp. Files saved before expires_at_ts was added
+            only have the ISO string, which is parsed instead.
+    """
+    expires_at_ts = token_data.get('expires_at_ts')
+    if expires_at_ts is not None:
+        return expires_at_ts
+    return (datetime.fromisoformat(token_data['expires_at']) - datetime(1970, 1, 1)).total_seconds()
+
 def is_token_valid(token_data, buffer_minutes=20):
     """
     Check if a token is still valid (not expired)
@@ -100,60 +230,112 @@ def is_token_valid(token_data, buffer_minutes=20):
         if not token_data or not token_data.get('expires_at'):
             return False
         
-        expires_at = datetime.fromisoformat(token_data['expires_at'])
-        now = datetime.utcnow()
+        time_remaining = _expires_at_ts(token_data) - time.time()
         
         # Add buffer to avoid edge cases (refresh proactively)
-        is_valid = expires_at > (now + timedelta(minutes=buffer_minutes))
+        is_valid = time_remaining > buffer_minutes * 60
         
         if is_valid:
-            time_remaining = expires_at - now
-            print(f"Token is valid. Expires in {time_remaining}")
+            log.debug("Token is valid. Expires in %ds", time_remaining)
         else:
-            print(f"Token has expired or will expire soon (within {buffer_minutes} minutes)")
+            log.info("Token has expired or will expire soon (within %s minutes)", buffer_minutes)
         
         return is_valid
         
     except Exception as e:
-        print(f"ERROR checking token validity: {str(e)}")
+        log.error("ERROR checking token validity: %s", e)
         return False
 
-def refresh_access_token():
+def refresh_access_token(current_token_data=None):
     """
     Refresh the access token using the refresh_token
     
     IMPORTANT: This function uses the refresh_token to get a NEW access_token
     and a NEW refresh_token. Both must be saved!
     
+    Concurrent calls in this process share a single refresh request.
+    
+    Args:
+        current_token_data (dict): Token just loaded from the file by the
+            caller, to avoid loading it again (default: load it here)
+    
     Returns:
         dict: New token data if refresh was successful, None otherwise
     """
-    print("Attempting to refresh access token...")
+    log.info("Attempting to refresh access token...")
     
-    token_data = load_token_from_file()
+    token_data = current_token_data or load_token_from_file()
     if not token_data or not token_data.get('refresh_token'):
-        print("No refresh token available. User must reconnect.")
+        log.warning("No refresh token available. User must reconnect.")
         return None
     
+    realm_id = token_data.get('realm_id')
+    with _refresh_inflight_lock:
+        inflight = _refresh_inflight.get(realm_id)
+        if inflight is None:
+            future = _refresh_inflight[realm_id] = Future()
+    
+    if inflight is not None:
+        log.debug("Token refresh already in progress. Waiting for it...")
+        try:
+            return inflight.result(timeout=QB_REFRESH_WAIT_SECONDS)
+        except Exception:
+            log.warning("Timeout while waiting for token refresh")
+            return None
+    
+    new_token_data = None
+    try:
+        new_token_data = _refresh_with_file_lock(token_data)
+    finally:
+        with _refresh_inflight_lock:
+            _refresh_inflight.pop(realm_id, None)
+        future.set_result(new_token_data)
+    return new_token_data
+
+def _refresh_with_file_lock(token_data):
+    """
+    Refresh token_data while holding the cross-worker lock
+
+    Once the lock is held the token file is read again: if another worker
+    refreshed (or the user reconnected) in the meantime, its new token is
+    returned instead of spending the old refresh token.
+
+    Args:
+        token_data (dict): Token whose refresh_token should be used
+
+    Returns:
+        dict: New token data, or None if the refresh failed
+    """
+    if fcntl is None:
+        return _request_token_refresh(token_data)
+
+    with open(TOKEN_LOCK_PATH, 'a') as lock_file:
+        # Released when the file is closed
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+        current = load_token_from_file()
+        if not current:
+            log.warning("Token file removed while waiting to refresh. User must reconnect.")
+            return None
+        if current.get('refresh_token') != token_data.get('refresh_token'):
+            log.info("Token already refreshed by another worker")
+            return current
+        return _request_token_refresh(current)
+
+def _request_token_refresh(token_data):
+    """Exchange token_data's refresh_token for new tokens and save them"""
     try:
         # Call QuickBooks token endpoint with refresh_token
-        response = requests.post(
+        response = _token_session.post(
             QB_TOKEN_URL,
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/x-www-form-urlencoded"
-            },
-            auth=(QB_CLIENT_ID, QB_CLIENT_SECRET),
-            data={
-                "grant_type": "refresh_token",
-                "refresh_token": token_data.get('refresh_token')
-            },
+            headers=_TOKEN_HEADERS,
+            data="grant_type=refresh_token&refresh_token=" + quote_plus(token_data.get('refresh_token')),
             timeout=10
         )
         
         if response.status_code == 200:
-            tokens = response.json()
-            print("Successfully refreshed access token")
+            tokens = _loads(response.content)
+            log.info("Successfully refreshed access token")
             
             # CRITICAL: Save BOTH the new access_token AND the new refresh_token
             # QuickBooks returns a NEW refresh_token with each refresh
@@ -165,20 +347,21 @@ def refresh_access_token():
             )
             
             if success:
-                return load_token_from_file()
+                # The dict just written - no need to stat/read the file back
+                with _file_cache_lock:
+                    return dict(_file_cache["data"])
             else:
-                print("Failed to save refreshed token")
+                log.error("Failed to save refreshed token")
                 return None
         else:
-            print(f"Failed to refresh token. Status: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.error("Failed to refresh token. Status: %s - %s", response.status_code, response.text)
             return None
             
     except requests.exceptions.Timeout:
-        print("Timeout while refreshing token")
+        log.warning("Timeout while refreshing token")
         return None
     except Exception as e:
-        print(f"ERROR refreshing token: {str(e)}")
+        log.error("ERROR refreshing token: %s", e)
         return None
 
 def get_valid_token():
@@ -194,22 +377,69 @@ def get_valid_token():
     token_data = load_token_from_file()
     
     if not token_data:
-        print("No token found. User must connect to QuickBooks.")
+        log.info("No token found. User must connect to QuickBooks.")
         return None
     
     # Check if token is valid (with 20-minute buffer)
     if not is_token_valid(token_data, buffer_minutes=20):
-        print("Token expired or expiring soon. Attempting refresh...")
-        token_data = refresh_access_token()
+        log.info("Token expired or expiring soon. Attempting refresh...")
+        token_data = refresh_access_token(token_data)
         
         if not token_data:
-            print("Failed to refresh token. User must reconnect.")
+            log.error("Failed to refresh token. User must reconnect.")
             return None
         
-        print("Token refreshed successfully")
+        log.info("Token refreshed successfully")
     
     return token_data
 
+def get_cached_token():
+    """
+    Get a valid QuickBooks token without re-reading the token file on every call
+    
+    The parsed token is kept in memory and reused as long as the token is
+    still valid and the file's mtime is unchanged (checked at most every
+    QB_TOKEN_RECHECK_SECONDS). Otherwise this falls back to get_valid_token(),
+    which reloads (and refreshes if needed).
+    
+    The lock only covers reading and publishing the cached token: a refresh
+    runs outside it, so other threads aren't stuck behind the token POST,
+    and concurrent refreshes are merged by refresh_access_token().
+    
+    Returns:
+        dict: Valid token data, or None if unable to get/refresh token
+    """
+    with _token_cache_lock:
+        cached = _token_cache["data"]
+        mtime = _token_cache["mtime"]
+        now = time.monotonic()
+        if cached and now < _token_cache["refresh_after"]:
+            if now < _token_cache["recheck_at"]:
+                return cached
+        else:
+            cached = None
+    
+    if cached and _token_file_mtime() == mtime:
+        with _token_cache_lock:
+            if _token_cache["data"] is cached:
+                _token_cache["recheck_at"] = now + QB_TOKEN_RECHECK_SECONDS
+        return cached
+    
+    token_data = get_valid_token()
+    
+    # get_valid_token() may have refreshed and rewritten the file.
+    # It only returns tokens whose expires_at parsed fine.
+    file_mtime = _token_file_mtime()
+    refresh_after = 0.0
+    if token_data:
+        refresh_after = time.monotonic() + _expires_at_ts(token_data) - 20 * 60 - time.time()
+    with _token_cache_lock:
+        _token_cache["data"] = token_data
+        _token_cache["mtime"] = file_mtime
+        _token_cache["refresh_after"] = refresh_after
+        _token_cache["recheck_at"] = time.monotonic() + QB_TOKEN_RECHECK_SECONDS
+    return token_data
+
 def delete_token_file():
     """
     Delete the token file (used for disconnecting)
@@ -218,16 +448,18 @@ def delete_token_file():
         bool: True if deletion was successful, False otherwise
     """
     try:
-        if os.path.exists(TOKEN_FILE_PATH):
+        with _file_cache_lock:
+            _file_cache["data"] = None
+        _token_cache["recheck_at"] = 0.0
+        try:
             os.remove(TOKEN_FILE_PATH)
-            print(f"Token file deleted: {TOKEN_FILE_PATH}")
-            return True
-        else:
-            print(f"Token file not found (already deleted?): {TOKEN_FILE_PATH}")
-            return True
+            log.info("Token file deleted: %s", TOKEN_FILE_PATH)
+        except FileNotFoundError:
+            log.info("Token file not found (already deleted?): %s", TOKEN_FILE_PATH)
+        return True
         
     except Exception as e:
-        print(f"ERROR deleting token file: {str(e)}")
+        log.error("ERROR deleting token file: %s", e)
         return False
 
 def get_token_info():